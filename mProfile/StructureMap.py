@@ -6,15 +6,25 @@ from __future__ import division
 from argparse import ArgumentParser
 import sys
 import pysam as ps
+from multiprocessing import Pool
+from mProfile.parallel import ordered_map
+from mProfile.sprofile import SprofileRows, SprofileWriter
+from mProfile.fragments import FragmentSizes, SizeHistogram
+from mProfile.breakpoints import EventClusters, RowRecords
 
 def argypargy():
     parser = ArgumentParser(description="StructureMap -i input.sam -o output.sprofile")
     req_args = parser.add_argument_group('Required arguments')
     add_args = parser.add_argument_group('Additional arguments')
     req_args.add_argument("--input", "-i", help="Input alignment file of SAM/BAM/CRAM format MUST be paired end and sorted")
-    req_args.add_argument("--output", "-o", help="Output structure profile, referred to as .sprofile files, is a tab delimited table.")
-    add_args.add_argument("--insert_max", "-im", help="Maximum size of input DNA fragments, over which deletions are annotated, default=2000", nargs='?', default=2000)
-    add_args.add_argument("--fragment_sizes", "-fs", help="Optional output file for the fragment size of correctly mapped reads")
+    req_args.add_argument("--output", "-o", help="Output structure profile, referred to as .sprofile files, is a tab delimited table. bgzip compressed if it ends with .gz, binary if it ends with .sprofb.")
+    add_args.add_argument("--insert_max", "-im", help="Maximum size of input DNA fragments, over which deletions are annotated, or 'auto' to estimate it from the fragment sizes of the first 100000 correctly mapped reads, default=2000", nargs='?', default=2000)
+    add_args.add_argument("--fragment_sizes", "-fs", help="Optional output file for the fragment size distribution of correctly mapped reads, a table of the number of reads of each size after summary statistics (median, MAD, percentiles and a suggested --insert_max)")
+    add_args.add_argument("--fragment_contigs", "-fc", help="Adds a column for each contig to the --fragment_sizes (-fs) table", action='store_true')
+    add_args.add_argument("--events", "-e", help="Optional output file for structural variant events, the aberrant pairs clustered by contigs, strands, aberration and position, with the number of pairs supporting each")
+    add_args.add_argument("--cluster_window", "-cw", help="Distance within which the reads of pairs are clustered into the same event with --events (-e), default=--insert_max")
+    add_args.add_argument("--min_support", "-ms", help="Minimum number of pairs for an event to be written with --events (-e), default=2", default=2)
+    add_args.add_argument("--threads", "-t", help="Number of processes, an indexed BAM/CRAM is split into regions that are processed in parallel. Otherwise the threads are used to decompress the file. default=1", default=1)
     args = parser.parse_args()
 
     if len(sys.argv)==1:
@@ -30,11 +40,31 @@ def argypargy():
         print("\nINPUT ERROR: Please provide an input file with the correct file extension (.sam, .cram, .bam).\n")
         sys.exit()
 
+    if str(args.insert_max).lower() == "auto":
+        args.insert_max = None
+    else:
+        try:
+            args.insert_max=int(args.insert_max)
+        except ValueError:
+            print("\n--insert_max is not a valid number, running as default (2000).\n")
+            args.insert_max = 2000
+
     try:
-        args.insert_max=int(args.insert_max)
+        if args.cluster_window is not None:
+            args.cluster_window=int(args.cluster_window)
+        args.min_support=int(args.min_support)
     except ValueError:
-        print("\n--insert_max is not a valid number, running as default (2000).\n")
-        args.large = 2000
+        print("\nINPUT ERROR: --cluster_window (-cw) and --min_support (-ms) must be numbers.\n")
+        sys.exit()
+
+    try:
+        args.threads=int(args.threads)
+    except ValueError:
+        print("\n--threads is not a valid number, running with 1.\n")
+        args.threads = 1
+    if args.threads < 1:
+        print("\n--threads must be at least 1, running with 1.\n")
+        args.threads = 1
 
     return(args)
 
@@ -42,94 +72,222 @@ args = argypargy()
 
 
 
-def alignprocess(input=args.input, output=args.output, insertmax=args.insert_max, sizes=args.fragment_sizes):
-    # BAM file flag interpretation dict
-    # BAM file must be sorted; the following categories rely on the first read of each pair that is found in the file having smaller coordinate, as this is the only one processed.
-    flags = {
-        "unmap":[73, 133, 89, 121, 165, 181, 101, 117, 153, 185, 69, 137, 77, 141], # 0x4 and/or 0x10, segment and/or next segment unmapped. no other categories have 0x4 or 0x10
-        "map":[99, 163], # 0x20 or 0x40 (not both), seq or next seq reverse complemented; 0x2, both segments properly aligned; reported where coordinate of read (163 or 99) is less its reverse complement (83 or 147), i.e. expected orientation. reported insert size is the distance between the far ends of each read, i.e. the actual fragment size.
-        "large_insert": [161, 97], # 0x20 or 0x40 (not both), seq or next seq reverse complemented; no 0x2, not properly aligned; reported where coordinate of read (161 or 97) is less its reverse complement (81 or 145), i.e. expected orientation. reported insert size is the distance between the far ends of each read, i.e. the actual fragment size.
-        "diverging":[81, 145], # 0x20 or 0x40 (not both), seq or next seq reverse complemented; no 0x2, not properly aligned; reported where coordinate of reverse complement read (81 or 145) is less than other read (161 or 97), i.e. opposite to expected orientation. reported insert size is the gap between the reads, including neither of the actual read lengths.
-        "costrand":[67, 131, 115, 179, 65, 129, 113, 177], # 0x20 and 0x40, or neither 0x20 or 0x40, both seq and next seq reverse complemented or not; can include 0x2, each segment properly aligned
-        "other_map": [147, 83] # mapped and proprly paired; but reported where coordinate of reverse read (83 or 147) is less than other read (163 or 99). Should not usually see these as properly paired and bam is ordered (occurs when a read starts from 'within the fragemnt' that is seen from the read pair). reported insert size is the overlap between the two reads, i.e. only the part which was sequenced in both directions.
-        }
+# BAM file flag interpretation dict
+# BAM file must be sorted; the following categories rely on the first read of each pair that is found in the file having smaller coordinate, as this is the only one processed.
+flags = {
+    "unmap":[73, 133, 89, 121, 165, 181, 101, 117, 153, 185, 69, 137, 77, 141], # 0x4 and/or 0x10, segment and/or next segment unmapped. no other categories have 0x4 or 0x10
+    "map":[99, 163], # 0x20 or 0x40 (not both), seq or next seq reverse complemented; 0x2, both segments properly aligned; reported where coordinate of read (163 or 99) is less its reverse complement (83 or 147), i.e. expected orientation. reported insert size is the distance between the far ends of each read, i.e. the actual fragment size.
+    "large_insert": [161, 97], # 0x20 or 0x40 (not both), seq or next seq reverse complemented; no 0x2, not properly aligned; reported where coordinate of read (161 or 97) is less its reverse complement (81 or 145), i.e. expected orientation. reported insert size is the distance between the far ends of each read, i.e. the actual fragment size.
+    "diverging":[81, 145], # 0x20 or 0x40 (not both), seq or next seq reverse complemented; no 0x2, not properly aligned; reported where coordinate of reverse complement read (81 or 145) is less than other read (161 or 97), i.e. opposite to expected orientation. reported insert size is the gap between the reads, including neither of the actual read lengths.
+    "costrand":[67, 131, 115, 179, 65, 129, 113, 177], # 0x20 and 0x40, or neither 0x20 or 0x40, both seq and next seq reverse complemented or not; can include 0x2, each segment properly aligned
+    "other_map": [147, 83] # mapped and proprly paired; but reported where coordinate of reverse read (83 or 147) is less than other read (163 or 99). Should not usually see these as properly paired and bam is ordered (occurs when a read starts from 'within the fragemnt' that is seen from the read pair). reported insert size is the overlap between the two reads, i.e. only the part which was sequenced in both directions.
+    }
 
-    # BAM file flag strandedness interpretation 
-    flagstrands = {
-        99:["+", "-"], 147:["-", "+"], 83:["-", "+"], 163:["+", "-"],
-        67:["+", "+"], 131:["+", "+"], 115:["-", "-"], 179:["-", "-"],
-        81:["-", "+"], 161:["+", "-"], 97:["+", "-"], 145:["-", "+"],
-        65:["+", "+"], 129:["+", "+"], 113:["-", "-"], 177:["-", "-"]
-        }
+# BAM file flag strandedness interpretation 
+flagstrands = {
+    99:["+", "-"], 147:["-", "+"], 83:["-", "+"], 163:["+", "-"],
+    67:["+", "+"], 131:["+", "+"], 115:["-", "-"], 179:["-", "-"],
+    81:["-", "+"], 161:["+", "-"], 97:["+", "-"], 145:["-", "+"],
+    65:["+", "+"], 129:["+", "+"], 113:["-", "-"], 177:["-", "-"]
+    }
 
-    if sizes:
-        size_file = open(args.fragment_sizes, 'w')
+# categories of flag_categories
+SKIP, MAP, LARGE_INSERT, DIVERGING, COSTRAND, OTHER, UNKNOWN, NO_STRANDS = range(8)
+
+def flag_tables():
+    # flags and flagstrands as two 4096 entry lists indexed by the flag itself, built once so each read needs one lookup rather than a scan of the flag lists.
+    # flags over 255 (supp alignment, not passed filters, duplicates, secondary alignments) and unmapped pairs are SKIP, flags without strands are NO_STRANDS.
+    categories = [SKIP]*4096
+    strands = [None]*4096
+    for flag in range(256):
+        if flag in flags['unmap']:
+            continue
+        elif flag not in flagstrands:
+            categories[flag] = NO_STRANDS
+            continue
+        strands[flag] = tuple(flagstrands[flag])
+        if flag in flags['map']:
+            categories[flag] = MAP
+        elif flag in flags['large_insert']:
+            categories[flag] = LARGE_INSERT
+        elif flag in flags['costrand']:
+            categories[flag] = COSTRAND
+        elif flag in flags['diverging']:
+            categories[flag] = DIVERGING
+        elif flag in flags['other_map']:
+            categories[flag] = OTHER
+        else:
+            categories[flag] = UNKNOWN
+    return(categories, strands)
 
-    past = set()
-    outlist = list() # Reads to be written to output file
+flag_categories, flag_strands = flag_tables()
+
+def classify_pairs(reads, insertmax, rows, sizes=None, first=-1):
+    # classifies each read pair from an iterator of reads, adding aberration rows to rows (an SprofileRows) and fragment sizes to the sizes histograms (a FragmentSizes, if given). returns the number of pairs (rc).
+    # reads that start before 'first' are skipped, as fetch() also returns reads that only overlap the start of a shard and those belong to the shard before.
+    # nothing is formatted or allocated for a read unless it is written as a row, the values are only turned into text by rows.add().
+    categories = flag_categories
+    strand_table = flag_strands
+    if sizes is not None:
+        max_size = sizes.max_size
+
+    # Only the first read of each pair is processed. Pairs with an unmapped read are skipped, so in a sorted file the first read is the one whose coordinate is less than its mate's (next_reference_id/start) and no read names need to be kept.
+    # Where both reads start at the same coordinate, the first one seen is found by name, and those names are dropped as soon as the sweep moves to the next coordinate, so memory is bounded by coverage rather than by file size.
+    same_coord = set()
+    here_ref = None
+    here_start = None
     rc = 0 # Counts number of aligned reads to normalise to
-    error = 0
 
-    with ps.AlignmentFile(input) as seqfil:
+    for line in reads:
+        flag = line.flag
+        category = categories[flag & 4095]
+
+        if category == SKIP: # flags over 255 and unmapped pairs
+            continue
+
+        start = line.reference_start
+        if start < first: # in the shard before
+            continue
+
+        if category == NO_STRANDS: # e.g. unpaired reads, whose mate_ref of -1 would otherwise pass as a mate seen first
+            raise KeyError(f"Flag {flag} not found in flagstrands dictionary on read number {rc+1}, {line.query_name}.")
+
+        ref = line.reference_id
+        mate_ref = line.next_reference_id
+        mate_start = line.next_reference_start
+        if start != here_start or ref != here_ref:
+            if ref != here_ref and sizes is not None:
+                size_counts = sizes.counts(ref)
+            here_ref = ref
+            here_start = start
+            same_coord.clear()
+        if mate_ref < ref or mate_ref == ref and mate_start < start: # mate was seen first
+            continue
+        elif mate_ref == ref and mate_start == start:
+            if line.query_name in same_coord:
+                continue
+            same_coord.add(line.query_name)
+
+        rc+=1
+        insert = line.template_length
+
+        if category == MAP:
+            if sizes is not None:
+                size = abs(insert)
+                size_counts[size if size <= max_size else max_size+size.bit_length()] += 1
+            if insert > insertmax: # Is a large deletion
+                strands = strand_table[flag]
+                rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], insert, "Deletion", flag)
+            continue
+
+        strands = strand_table[flag]
+        if mate_ref != ref:
+            rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], 0, "Inter-chromosomal translocation", flag)
+
+        elif category == LARGE_INSERT: # opposite strands, relative position and orientation of reads as expected, but too far apart to be properly mapped 
+            if sizes is not None:
+                size = abs(insert)
+                size_counts[size if size <= max_size else max_size+size.bit_length()] += 1
+            if insert > insertmax: 
+                rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], insert, "Deletion", flag)
+            else:
+                rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], insert, "Large insert", flag)
+
+        elif category == COSTRAND: # Same strand, could be classed as inversion or intrachromosomal translocation
+            rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], insert, "Same strand", flag)
+
+        elif category == DIVERGING: # opposite strands, relative orientation as expected but position of reverse read is less than forward read
+            rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], insert, "Diverging", flag)
+
+        elif category == OTHER: # opposite strands, relative orientation as expected but position of reverse read is less than forward read
+            rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], insert, "Other", flag)
+
+        else: # I don't know, probably don't exist
+            rows.add(ref, mate_ref, start, mate_start, strands[0], strands[1], insert, "Unknown", flag)
+    return(rc)
+
+# the alignment file of each worker process, opened on its first shard and reused for the rest.
+alignments = {}
+
+def shard_process(argues):
+    # classifies the pairs whose first read starts in one shard (contig, start, end) of an indexed alignment file.
+    # returns the shard's aberration rows (with their values, to be clustered, if events), fragment size histograms and rc, so shards can be merged in genome order.
+    input=argues[0]
+    contig=argues[1]
+    start=argues[2]
+    end=argues[3]
+    insertmax=argues[4]
+    sizes=argues[5]
+    binary=argues[6]
+    per_contig=argues[7]
+    events=argues[8]
+    if input not in alignments:
+        alignments[input] = ps.AlignmentFile(input)
+    seqfil = alignments[input]
+    rows = SprofileRows(seqfil.references, binary=binary, events=RowRecords() if events else None)
+    size_hist = FragmentSizes(seqfil.references, per_contig) if sizes else None
+    rc = classify_pairs(seqfil.fetch(contig, start, end), insertmax, rows, size_hist, first=start)
+    return([rows.take(), rows.events, size_hist, rc])
+
+def shards(seqfil, window=10000000):
+    # splits each contig of the alignment file into windows, in the order of the header (the order of a sorted file).
+    regions = list()
+    for contig, length in zip(seqfil.references, seqfil.lengths):
+        for start in range(0, length, window):
+            regions.append((contig, start, min(start+window, length)))
+    return(regions)
+
+def estimate_insert_max(input, sample=100000, threads=1):
+    # --insert_max from the fragment sizes of the first properly paired reads of the file.
+    histogram = SizeHistogram()
+    with ps.AlignmentFile(input, threads=threads) as seqfil:
         for line in seqfil:
-            if line.query_name not in past:
-                past.add(line.query_name)
-                flag = line.flag
-
-                if flag > 255:  # added to skip supp alignment, not passed filters, duplicates, secondary alignments
-                    continue
-
-                elif flag in flags['unmap']:
-                    continue
-
-                rc+=1
-                chr_x = line.reference_name
-                chr_y = line.next_reference_name 
-                coord_x = str(line.reference_start)
-                coord_y = str(line.next_reference_start)
-                try:
-                    strands = flagstrands[flag]
-                except KeyError as e:
-                    raise KeyError(f"Flag {flag} not found in flagstrands dictionary on read number {rc}, {line.query_name}.\nError: {e}")
-                insert = line.template_length
-
-                if flag in flags['map']:
-                    if sizes:
-                        temp = size_file.write(str(abs(line.template_length)) +"\n")
-                    if insert > insertmax: # Is a large deletion
-                        outlist.append("\t".join([chr_x, chr_y, coord_x, coord_y, strands[0], strands[1], str(insert), "Deletion", str(flag)]) +"\n")
-
-                else:
-                    if chr_y != chr_x: 
-                        outlist.append("\t".join([chr_x, chr_y, coord_x, coord_y, strands[0], strands[1], "0", "Inter-chromosomal translocation", str(flag)]) +"\n")
-                        continue
-                
-                    elif flag in flags['large_insert']: # opposite strands, relative position and orientation of reads as expected, but too far apart to be properly mapped 
-                        if sizes:
-                            temp = size_file.write(str(abs(line.template_length)) +"\n")
-                        if insert > insertmax: 
-                            outlist.append("\t".join([chr_x, chr_y, coord_x, coord_y, strands[0], strands[1], str(insert), "Deletion", str(flag)]) +"\n")
-                        else:
-                            outlist.append("\t".join([chr_x, chr_y, coord_x, coord_y, strands[0], strands[1], str(insert), "Large insert", str(flag)]) +"\n")
-
-                    elif flag in flags['costrand']: # Same strand, could be classed as inversion or intrachromosomal translocation
-                        outlist.append("\t".join([chr_x, chr_y,coord_x,coord_y, strands[0], strands[1], str(insert), "Same strand", str(flag)]) +"\n")
-
-                    elif flag in flags['diverging']: # opposite strands, relative orientation as expected but position of reverse read is less than forward read
-                        outlist.append("\t".join([chr_x, chr_y,coord_x,coord_y, strands[0], strands[1], str(insert), "Diverging", str(flag)]) +"\n")
-
-                    elif flag in flags['other_map']: # opposite strands, relative orientation as expected but position of reverse read is less than forward read
-                        outlist.append("\t".join([chr_x, chr_y, coord_x, coord_y, strands[0], strands[1], str(insert), "Other", str(flag)]) +"\n")
-                        
-                    else: # I don't know, probably don't exist
-                        outlist.append("\t".join([chr_x, chr_y,coord_x,coord_y, strands[0], strands[1], str(insert), "Unknown", str(flag)]) +"\n")
+            if line.flag in flags['map']:
+                histogram.add(abs(line.template_length))
+                sample -= 1
+                if sample == 0:
+                    break
+    if histogram.total() == 0:
+        return(2000)
+    return(histogram.insert_max())
+
+def alignprocess(input=args.input, output=args.output, insertmax=args.insert_max, sizes=args.fragment_sizes, threads=args.threads, per_contig=args.fragment_contigs, events=args.events, window=args.cluster_window, min_support=args.min_support):
+    if insertmax is None:
+        insertmax = estimate_insert_max(input, threads=threads)
+        print("\n--insert_max estimated as "+str(insertmax)+" from the fragment sizes of the first properly paired reads.\n")
+
+    # htslib decompresses the file with the extra threads
+    with ps.AlignmentFile(input, threads=threads) as seqfil:
+        # rows are written to the output as they are found, fragment sizes are counted and written at the end
+        # aberrant pairs are clustered into events as they are written, if events
+        clusters = None
+        if events:
+            clusters = EventClusters(events, seqfil.references, window=insertmax if window is None else window, min_support=min_support)
+        rows = SprofileWriter(output, seqfil.references, events=clusters)
+        size_hist = FragmentSizes(seqfil.references, per_contig) if sizes else None
+        if threads > 1 and seqfil.has_index():
+            # each pair is counted in the shard holding its first read, so pairs across shard boundaries are counted once. Shards are merged in order, the output is the same as a single process run.
+            rc = 0
+            p=Pool(threads)
+            for shard_rows, shard_events, shard_sizes, shard_rc in ordered_map(p, shard_process, [[input, contig, start, end, insertmax, sizes is not None, rows.binary, per_contig, clusters is not None] for contig, start, end in shards(seqfil)], threads*2):
+                rows.write(shard_rows)
+                if clusters is not None:
+                    for row in shard_events:
+                        clusters.add(*row)
+                if sizes:
+                    size_hist.merge(shard_sizes)
+                rc += shard_rc
+            p.close()
+            p.join()
+        else:
+            rc = classify_pairs(seqfil, insertmax, rows, size_hist)
+
     if sizes:
-        size_file.close()
+        size_hist.write(sizes)
 
-    with open(args.output, 'w') as outfil:
-        temp = outfil.write("Chr FW\tChr RV\tCoord FW\tCoord RV\tStrand FW\tStrand RV\tInsert bp\tAbberation\tFlag, reads="+str(rc)+"\n")
-        for line in outlist:
-            temp = outfil.write(line)
+    rows.close(rc)
+    if events:
+        clusters.close()
 
 
 def main(args=argypargy()):
@@ -2,8 +2,14 @@
 from __future__ import division
 from argparse import ArgumentParser
 import sys
-from re import sub
+import os
+from math import sqrt
 from multiprocessing import Pool
+from mProfile.primers import PrimerPanel, read_primers, rev_comp
+from mProfile.parallel import ordered_map
+from mProfile.fileio import FastqReader, open_output
+from mProfile.translomap import diff_matrices
+from mProfile.junctions import JunctionCatalogue
 try:
     from itertools import izip as zip
 except ImportError:
@@ -15,28 +21,42 @@ def argypargy():
     parser = ArgumentParser(description='TransloCapture -1 input_read1.fastq -2 input_read2.fastq -o output.csv')
     req_args = parser.add_argument_group('Required arguments')
     add_args = parser.add_argument_group('Additional arguments')
-    req_args.add_argument("--input", "-i", help="Input fastq file for SR sequencing")
-    req_args.add_argument("--read1", "-1", help="Fastq read 1 from PE sequencing")
-    req_args.add_argument("--read2", "-2", help="Fastq read 2 from PE sequencing")
+    req_args.add_argument("--input", "-i", help="Input fastq file for SR sequencing, can be gzip/bgzip compressed or '-' for stdin.")
+    req_args.add_argument("--read1", "-1", help="Fastq read 1 from PE sequencing, can be gzip/bgzip compressed.")
+    req_args.add_argument("--read2", "-2", help="Fastq read 2 from PE sequencing, can be gzip/bgzip compressed.")
     req_args.add_argument("--output", "-o", help="Output file to write to, format is csv")
     add_args.add_argument("--control", "-c", help="The fastq you want to normalise to (e.g. untreated).\nIf unspecified, will not normalise.")
     add_args.add_argument("--control1", "-c1", help="Read 1 of the fastq you want to normalise to (e.g. untreated).\nIf unspecified, will not normalise.")
     add_args.add_argument("--control2", "-c2", help="Read 2 of the fastq you want to normalise to (e.g. untreated).\nIf unspecified, will not normalise.")
     req_args.add_argument("--primers", "-p", help="A 3 column .csv file of the name, foward primer sequence and reverse primer sequence (reverse complement) for each site to be analysed.")
-    add_args.add_argument("--preproc", "-pp", help="If specified, --input (-i) and --control (-c) must be already quantified TransloCapture matrices.\nOutput will be a new matrix that is the differential of input-control.", action='store_true')
-    add_args.add_argument("--translocated", "-t", help="Fastq file to write translocated sequences to.\n If unspecified, will not write")
-    add_args.add_argument("--translocated1", "-t1", help="Fastq file to write read1 of translocated sequences to.\n If unspecified, will not write.")
-    add_args.add_argument("--translocated2", "-t2", help="Fastq file to write read2 of translocated sequences to.\n If unspecified, will not write.")
-    add_args.add_argument("--fastqout", "-fq", help="Fastq file to write non-translocated sequences to.\n If unspecified, will not write")
-    add_args.add_argument("--fastqout1", "-fq1", help="Fastq file to write read1 of non-translocated sequences to.\n If unspecified, will not write.")
-    add_args.add_argument("--fastqout2", "-fq2", help="Fastq file to write read2 of non-translocated sequences to.\n If unspecified, will not write.")
+    add_args.add_argument("--preproc", "-pp", help="If specified, --input (-i) and --control (-c) must be already quantified TransloCapture matrices.\nOutput will be a new matrix that is the differential of input-control, matched by target name.\nSeveral treated matrices can be given to --input (-i) and --output (-o) as comma separated lists.", action='store_true')
+    add_args.add_argument("--translocated", "-t", help="Fastq file to write translocated sequences to, gzip compressed if it ends with .gz.\n If unspecified, will not write")
+    add_args.add_argument("--translocated1", "-t1", help="Fastq file to write read1 of translocated sequences to, gzip compressed if it ends with .gz.\n If unspecified, will not write.")
+    add_args.add_argument("--translocated2", "-t2", help="Fastq file to write read2 of translocated sequences to, gzip compressed if it ends with .gz.\n If unspecified, will not write.")
+    add_args.add_argument("--fastqout", "-fq", help="Fastq file to write non-translocated sequences to, gzip compressed if it ends with .gz.\n If unspecified, will not write")
+    add_args.add_argument("--fastqout1", "-fq1", help="Fastq file to write read1 of non-translocated sequences to, gzip compressed if it ends with .gz.\n If unspecified, will not write.")
+    add_args.add_argument("--fastqout2", "-fq2", help="Fastq file to write read2 of non-translocated sequences to, gzip compressed if it ends with .gz.\n If unspecified, will not write.")
     add_args.add_argument("--sensitivity", "-s", help="Pads window at start of reads for identify the primer used for amplification.\nLarger numbers increase detection, but reduce specificity. default=2, max=10.", default=2)
+    add_args.add_argument("--max_mismatches", "-mm", help="Number of mismatched bases allowed when matching each primer, so reads with a sequencing error in the primer are still counted. Where similar primers both match, the reading with the fewest mismatches is used, and a canonical amplicon over a crossover. default=0 i.e. exact matches only.", default=0)
+    add_args.add_argument("--threads", "-th", help="Number of processes used to classify reads, the fastq files are split into chunks of reads that are classified in parallel. default=1.", default=1)
+    add_args.add_argument("--junctions", "-j", help="Csv file to write the most frequent junction sequences (between the donor and acceptor primers) of each crossover to.\nWith a control, the junctions are those of the --input (-i) sample. If unspecified, will not write.")
+    add_args.add_argument("--top_junctions", "-tj", help="Number of junctions written for each crossover with --junctions (-j). default=10.", default=10)
+    add_args.add_argument("--interim", "-n", help="Writes the matrix so far to --output (-o) every n reads, along with each crossover's 95%% confidence interval to output.progress.csv. default=0 i.e. only at the end.", default=0)
+    add_args.add_argument("--ci_width", "-w", help="Stops reading once the 95%% confidence interval of every crossover is narrower than this (in %% of reads, e.g. 0.01).\nIf unspecified, all reads are used.")
+    add_args.add_argument("--max_reads", "-mr", help="Stops after this many reads (or read pairs).\nIf unspecified, all reads are used.")
+    add_args.add_argument("--batch", "-bt", help="Tab separated sample sheet of the output matrix, the fastq (or read1,read2) and optionally the control fastq (or read1,read2) of each sample, one sample per line.\nEvery fastq is processed once with --threads (-th) processes and --output (-o) is written as a table of all the samples.")
     add_args.add_argument("--quiet", "-q", help="Removes all messages.", action='store_true')
     args = parser.parse_args()
     if len(sys.argv)==1: # If no arguments are given, print help information.
         parser.print_help()
         sys.exit()
-    if args.input is None and args.read1 is None: # Input file is required
+    if args.batch is not None and (args.input is not None or args.read1 is not None or args.control is not None or args.control1 is not None or args.preproc == True): # The sample sheet lists the inputs
+        print("\nTransloCapture ERROR: --batch (-bt) lists the fastq files and controls, it cannot be used alongside --input (-i), --read1/2 (-1/2), --control (-c), --control1/2 (-c1/2) or --preproc (-pp).\n")
+        sys.exit()
+    if args.batch is not None and (args.translocated is not None or args.translocated1 is not None or args.fastqout is not None or args.fastqout1 is not None): # Read outputs are per sample
+        print("\nTransloCapture ERROR: --batch (-bt) cannot write the reads with --translocated (-t/-t1/-t2) or --fastqout (-fq/-fq1/-fq2).\n")
+        sys.exit()
+    if args.input is None and args.read1 is None and args.batch is None: # Input file is required
         print("\nTransloCapture ERROR: Please provide an input file with --input (-i) or with --read1 and --read2 (-1 -2) for PE seqeuencing.\n")
         sys.exit()
     if args.output is None: # Output file is required
@@ -75,6 +95,9 @@ def argypargy():
     if args.preproc == True and args.control is None: # Preproc needs a control
         print("\nTransloCapture ERROR: --preproc (-pp) also needs --control (-c) to calculate a differential to the --input (-i) sample.\n")
         sys.exit()
+    if args.preproc == True and args.input is not None and args.output is not None and len(args.input.split(",")) != len(args.output.split(",")): # One output per treated matrix
+        print("\nTransloCapture ERROR: --preproc (-pp) needs an --output (-o) for each --input (-i) matrix, as comma separated lists of the same length.\n")
+        sys.exit()
     if args.preproc == True and args.read1 is not None: # Need to use SR options for preproc
         print("\nTransloCapture ERROR: --read1/2 (-1/2) and --control1/2 (-c1/2) are for paired fastq files.\nPlease use --input (-i) and --control (-c) with --preproc (-pp).\n")
         sys.exit()        
@@ -100,20 +123,146 @@ def argypargy():
     elif args.sensitivity > 10: # Sensitivity limit warning
         print("\nTransloCapture WARNING: --sensitivity (-s) must not exceed 10, TransloCapture will run with a sensitivity of 10.\n")
         args.sensitivity = 10
-    return(args)
-def numsafe(anum):
     try:
-        float(anum)
-        return(True)
+        args.max_mismatches = int(args.max_mismatches)
     except ValueError:
-        return(False)
-def rev_comp(seq):
-    newseq = seq.replace("A", "t")
-    newseq = newseq.replace("T", "a")
-    newseq = newseq.replace("G", "c")
-    newseq = newseq.replace("C", "g")
-    return(newseq.upper()[::-1])
-def TransloCapture(argues):
+        print("\nTransloCapture ERROR: --max_mismatches (-mm) must be a number.\n")
+        sys.exit()
+    if args.max_mismatches < 0:
+        print("\nTransloCapture ERROR: --max_mismatches (-mm) cannot be negative.\n")
+        sys.exit()
+    try:
+        args.top_junctions = int(args.top_junctions)
+    except ValueError:
+        print("\nTransloCapture ERROR: --top_junctions (-tj) must be a number.\n")
+        sys.exit()
+    if args.junctions is not None and (args.batch is not None or args.preproc == True): # Junctions come from the reads of one sample
+        print("\nTransloCapture ERROR: --junctions (-j) needs the fastq of a sample, it cannot be used with --batch (-bt) or --preproc (-pp).\n")
+        sys.exit()
+    try:
+        args.interim = int(args.interim)
+        if args.ci_width is not None:
+            args.ci_width = float(args.ci_width)
+        if args.max_reads is not None:
+            args.max_reads = int(args.max_reads)
+    except ValueError:
+        print("\nTransloCapture ERROR: --interim (-n), --ci_width (-w) and --max_reads (-mr) must be numbers.\n")
+        sys.exit()
+    if (args.interim > 0 or args.ci_width is not None or args.max_reads is not None) and (args.control is not None or args.control1 is not None or args.batch is not None or args.preproc == True): # Progress is followed for one sample
+        print("\nTransloCapture ERROR: --interim (-n), --ci_width (-w) and --max_reads (-mr) follow the matrix of a single sample, they cannot be used with a control, --batch (-bt) or --preproc (-pp).\n")
+        sys.exit()
+    try:
+        args.threads = int(args.threads)
+    except ValueError:
+        print("\nTransloCapture ERROR: --threads (-th) must be a number.\n")
+        sys.exit()
+    if args.threads < 1:
+        print("\nTransloCapture WARNING: --threads (-th) must be at least 1, TransloCapture will run with 1.\n")
+        args.threads = 1
+    return(args)
+# the primer index of each worker process, built on its first chunk and reused for the rest.
+panels = {}
+
+def primer_panel(site_file, sens, paired, mismatches=0):
+    key = (site_file, sens, paired, mismatches)
+    if key not in panels:
+        panels[key] = PrimerPanel(site_file, sens, paired=paired, mismatches=mismatches)
+    return(panels[key])
+def fastq_chunks(fastq, limit=None):
+    # yields the fastq as blocks of text holding whole records, which are cheap to hand to another process.
+    # limit(reads so far) gives the most records the next chunk may hold (see Progress.chunk_limit), or None for a whole block. Reading stops when it is 0.
+    with FastqReader(fastq) as reader:
+        handed = 0
+        while True:
+            most = None if limit is None else limit(handed)
+            if most == 0:
+                break
+            chunk, reads = reader.chunk(most=most)
+            if reads == 0:
+                break
+            handed += reads
+            yield(chunk)
+def paired_chunks(fastq1, fastq2, limit=None):
+    # yields R1 and R2 chunks holding the same number of records, so the reads stay paired. limit is as in fastq_chunks.
+    with FastqReader(fastq1) as reader1, FastqReader(fastq2) as reader2:
+        handed = 0
+        while True:
+            most = None if limit is None else limit(handed)
+            if most == 0:
+                break
+            chunk1, reads = reader1.chunk(most=most)
+            if reads == 0:
+                break
+            chunk2, reads2 = reader2.chunk(reads)
+            if reads2 == 0:
+                break
+            handed += reads
+            yield((chunk1, chunk2))
+def fastq_records(chunk):
+    # splits a chunk of fastq text into (header, seq, plus, qual) records.
+    lines = iter(chunk.split("\n"))
+    return(zip(lines, lines, lines, lines))
+def classify_chunk(argues):
+    # identifies which primers generated each read of a chunk of SR fastq text, or of a pair of R1 and R2 chunks.
+    # returns the chunk's crossover and readcounts as partial counts, with the fastq text of its translocated and regular reads, so chunks can be classified in any process and merged in order.
+    chunk=argues[0]
+    site_file=argues[1]
+    sens=argues[2]
+    paired=argues[3]
+    write_translocated=argues[4]
+    write_regular=argues[5]
+    mismatches=argues[6]
+    find_junctions=argues[7] if len(argues) > 7 else False
+    panel = primer_panel(site_file, sens, paired, mismatches)
+    primer_names = panel.names
+    if paired:
+        chunk = zip(fastq_records(chunk[0]), fastq_records(chunk[1]))
+    else:
+        chunk = fastq_records(chunk)
+    crossovers = {}
+    readcounts = {}
+    translocated = [list(), list()]
+    regular = [list(), list()]
+    junctions = {}
+    records = 0
+    for record in chunk:
+        records += 1
+        if paired:
+            sets = record
+            sequences = (record[0][1], record[1][1])
+        else:
+            sets = [record]
+            sequences = (record[1],)
+        if find_junctions:
+            found, head, tail = panel.match(*sequences)
+        else:
+            found = panel.classify(*sequences)
+        # If it is a crossover event, increase the value of that event by 1
+        # If it is a canonical target then increase the readcount for that target as this is then used for normalisation
+        if found is not None:
+            donor, acceptor, donor_end, acceptor_end = found
+            readcounts[primer_names[donor]] = readcounts.get(primer_names[donor], 0) + 1
+            if acceptor is not None:
+                event = primer_names[donor]+"-"+primer_names[acceptor]
+                crossovers[event] = crossovers.get(event, 0) + 1
+                if find_junctions:
+                    junction = panel.junction(found, head, tail, *sequences)
+                    event_junctions = junctions.setdefault(event, {})
+                    event_junctions[junction] = event_junctions.get(junction, 0) + 1
+                if write_translocated:
+                    label = " " + primer_names[donor] + "_" + donor_end + ":" + primer_names[acceptor] + "_" + acceptor_end
+                    for reads, lines in zip(translocated, sets):
+                        reads.append(lines[0] + label + "\n" + "\n".join(lines[1:]) + "\n")
+        if write_regular and (found is None or found[1] is None):
+            for reads, lines in zip(regular, sets):
+                reads.append("\n".join(lines)+"\n")
+    return([crossovers, readcounts, [''.join(lines) for lines in translocated], [''.join(lines) for lines in regular], records, junctions])
+def merge_counts(counts, partial):
+    # adds the partial counts of a chunk to the totals.
+    for key, count in partial.items():
+        counts[key] += count
+def count_reads(argues):
+    # classifies every read of a sample and returns its crossover counts, the readcount of each target and the target names.
     fastq=argues[0]
     fastq1=argues[1]
     fastq2=argues[2]
@@ -125,195 +274,143 @@ def TransloCapture(argues):
     regular1=argues[8]
     regular2=argues[9]
     sens=argues[10]
-    # First, generate lists of the primer targets and their sequences to identify each site in the fastqs
-    primer_names = list()
-    fw_primer_list = list()
-    rv_primer_list = list()
-    fw_lens = list()
-    rv_lens = list()
-    with open(site_file) as sites:
-        for site in sites:
-            primer_names.append(site.split(",")[0])
-            fw_primer_list.append(site.split(",")[1].upper()[1:])
-            rv_primer_list.append(sub("\n|\r", "", site.split(",")[2]).upper()[1:])
-            fw_lens.append(len(site.split(",")[1])+sens)
-            rv_lens.append(len(sub("\n|\r", "", site.split(",")[2]))+sens)
+    threads=argues[11] if len(argues) > 11 else 1
+    mismatches=argues[12] if len(argues) > 12 else 0
+    progress=argues[13] if len(argues) > 13 else None
+    junctions=argues[14] if len(argues) > 14 else None
+    top_junctions=argues[15] if len(argues) > 15 else 10
+    paired = fastq1 is not None
+    primer_names = primer_panel(site_file, sens, paired, mismatches).names
     # Make an empty dict and fill it with all the possible crossover events 
     samp_dict = {}
     for donor in primer_names:
         for acceptor in primer_names:
             samp_dict[donor+"-"+acceptor] = 0 
-    # Loop over each read and identify which primers generated it
-    # First identify the forward primer used, then identify the reverse
-    # If it is a crossover event, increase the value of that event in the dict by 1
-    # If it is a canonical target then increase then increase the readcoutn for that target as this is then used for normalisation
-    count = 0
     readcounts = {key:0 for key in primer_names}
-    lines1=list()
-    lines2=list()
-    if translocated is not None:
-        output = open(translocated, "w")
-    elif translocated1 is not None:
-        output1 = open(translocated1, "w")
-        output2 = open(translocated2, "w")
-    if regular is not None:
-        regout = open(regular, "w")
-    elif regular1 is not None:
-        regout1 = open(regular1, "w")
-        regout2 = open(regular2, "w")
-    if fastq1 is None:
-        with open(fastq) as samp_fq:
-            for rd in samp_fq:
-                count+=1
-                lines1.append(rd.strip("\n"))
-                if count%4==0:
-                    set1=lines1
-                    read=set1[1]
-                    count=0
-                    lines1=list()
-                    foundcheck=False
-                    for rv, fw, rv_l, fw_l, donor in zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens, primer_names):
-                        if foundcheck:
-                            break
-                        else:
-                            if fw in read[:fw_l]:
-                                if rev_comp(rv) in read[-(rv_l):]:
-                                    readcounts[donor] += 1
-                                    break
-                                else:
-                                    for all_rv, all_fw, arv_l, afw_l, acceptor in zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens, primer_names):
-                                        if donor != acceptor:
-                                            if rev_comp(all_rv) in read[-(arv_l):]: 
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_fw:" + acceptor + "_rv"
-                                                    output.write("\n".join(set1)+"\n")
-                                                break
-                                            elif rev_comp(all_fw) in read[-(afw_l):]:
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_fw:" + acceptor + "_fw"
-                                                    output.write("\n".join(set1)+"\n")
-                                                break
-
-                            elif rv in read[:rv_l]:
-                                if rev_comp(fw) in read[-(fw_l):]:
-                                    readcounts[donor] += 1
-                                    break
-                                else:
-                                    for all_rv, all_fw, arv_l, afw_l, acceptor in zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens, primer_names):
-                                        if donor != acceptor:
-                                            if rev_comp(all_fw) in read[-(afw_l):]: 
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_rv:" + acceptor + "_rv"
-                                                    output.write("\n".join(set1)+"\n")
-                                                break
-                                            elif rev_comp(all_rv) in read[-(arv_l):]: 
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_rv:" + acceptor + "_fw"
-                                                    output.write("\n".join(set1)+"\n")
-                                                break
-                    if not foundcheck and regular is not None:
-                        regout.write("\n".join(set1)+"\n") 
-
+    # the read outputs are buffered and written (and gzip compressed if they end with .gz) by a background thread each, so writing does not hold up classification.
+    translocated_out = [open_output(name, threaded=True) for name in [translocated, translocated1, translocated2] if name is not None]
+    regular_out = [open_output(name, threaded=True) for name in [regular, regular1, regular2] if name is not None]
+    # Loop over chunks of reads (or read pairs, kept in step) and identify which primers generated each read
+    # with --interim or --max_reads, chunks are cut at the interim points and at max_reads, so the matrices are written and reading stops at exactly those reads.
+    limit = None if progress is None else progress.chunk_limit
+    if paired:
+        chunks = paired_chunks(fastq1, fastq2, limit)
     else:
-        with open(fastq1) as fq1, open(fastq2) as fq2:
-            for rd1, rd2 in zip(fq1, fq2):
-                count+=1
-                lines1.append(rd1.strip("\n"))
-                lines2.append(rd2.strip("\n"))
-                if count%4==0:
-                    set1=lines1
-                    set2=lines2
-                    read1=set1[1]
-                    read2=set2[1]
-                    count=0
-                    lines1=list()
-                    lines2=list()
-                    foundcheck=False
-                    for rv, fw, rv_l, fw_l, donor in zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens, primer_names):
-                        if foundcheck:
-                            break
-                        else:
-                            if fw in read1[:fw_l]:
-                                if rv in read2[:rv_l]:
-                                    readcounts[donor] += 1                                    
-                                    break
-                                else:
-                                    for all_rv, all_fw, arv_l, afw_l, acceptor in zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens, primer_names):
-                                        if donor != acceptor:
-                                            if all_rv in read2[:arv_l]:
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated1 is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_fw:" + acceptor + "_rv"
-                                                    set2[0] = set2[0].strip("\n") + " " + donor + "_fw:" + acceptor + "_rv"
-                                                    output1.write("\n".join(set1)+"\n")
-                                                    output2.write("\n".join(set2)+"\n")
-                                                break
-                                            elif all_fw in read2[:afw_l]:
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated1 is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_fw:" + acceptor + "_fw"
-                                                    set2[0] = set2[0].strip("\n") + " " + donor + "_fw:" + acceptor + "_fw"
-                                                    output1.write("\n".join(set1)+"\n")
-                                                    output2.write("\n".join(set2)+"\n")
-                                                break                                                
-
-                            elif rv in read1[:rv_l]:
-                                if fw in read2[:fw_l]:
-                                    readcounts[donor] += 1                                      
-                                    break
-                                else:
-                                    for all_rv, all_fw, arv_l, afw_l, acceptor in zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens, primer_names):
-                                        if donor != acceptor:
-                                            if all_rv in read2[:arv_l]:
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated1 is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_rv:" + acceptor + "_rv"
-                                                    set2[0] = set2[0].strip("\n") + " " + donor + "_rv:" + acceptor + "_rv"
-                                                    output1.write("\n".join(set1)+"\n")
-                                                    output2.write("\n".join(set2)+"\n")
-                                                break
-                                            elif all_fw in read2[:afw_l]:
-                                                readcounts[donor] += 1
-                                                foundcheck=True
-                                                samp_dict[str(donor+"-"+acceptor)] += 1
-                                                if translocated1 is not None:
-                                                    set1[0] = set1[0].strip("\n") + " " + donor + "_rv:" + acceptor + "_fw"
-                                                    set2[0] = set2[0].strip("\n") + " " + donor + "_rv:" + acceptor + "_fw"
-                                                    output1.write("\n".join(set1)+"\n")
-                                                    output2.write("\n".join(set2)+"\n")
-                                                break
-                    if not foundcheck and regular1 is not None:
-                        regout1.write("\n".join(set1)+"\n")
-                        regout2.write("\n".join(set2)+"\n")                                            
-
-    if translocated is not None:
+        chunks = fastq_chunks(fastq, limit)
+    chunks = ([chunk, site_file, sens, paired, len(translocated_out) > 0, len(regular_out) > 0, mismatches, junctions is not None] for chunk in chunks)
+    # the junctions are catalogued here, as the table is written by whichever process counts the sample.
+    catalogue = JunctionCatalogue(top_junctions)
+    if threads > 1:
+        # chunks are classified in parallel and merged in their original order, so the read outputs are the same as a single process run.
+        p=Pool(threads)
+        results = ordered_map(p, classify_chunk, chunks, threads*2)
+    else:
+        results = (classify_chunk(chunk) for chunk in chunks)
+    stopped = False
+    for crossovers, counts, translocated_reads, regular_reads, reads, chunk_junctions in results:
+        merge_counts(samp_dict, crossovers)
+        merge_counts(readcounts, counts)
+        catalogue.merge(chunk_junctions)
+        for output, lines in zip(translocated_out, translocated_reads):
+            output.write(lines)
+        for output, lines in zip(regular_out, regular_reads):
+            output.write(lines)
+        if progress is not None and progress.update(samp_dict, readcounts, primer_names, reads):
+            stopped = True
+            break
+    if stopped:
+        # stops reading the fastqs.
+        results.close()
+    if threads > 1:
+        if stopped:
+            # the chunks still being classified are not needed.
+            p.terminate()
+        else:
+            p.close()
+        p.join()
+    if progress is not None:
+        progress.close()
+    for output in translocated_out+regular_out:
         output.close()
-    elif translocated1 is not None:
-        output1.close()
-        output2.close()
-    if regular is not None:
-        regout.close()
-    elif regular1 is not None:
-        regout1.close()
-        regout2.close()
+    if junctions is not None:
+        catalogue.write(junctions, primer_names)
+    return([samp_dict, readcounts, primer_names])
+def wilson_interval(count, total, z=1.96):
+    # the 95% Wilson score interval of a proportion count/total, in percent as in the matrices.
+    if total == 0:
+        return(0.0, 100.0)
+    rate = count/total
+    centre = (rate + z*z/(2*total))/(1 + z*z/total)
+    half = z*sqrt(rate*(1-rate)/total + z*z/(4*total*total))/(1 + z*z/total)
+    return(max(0.0, centre-half)*100, min(1.0, centre+half)*100)
+class Progress(object):
+    # interim matrices and early stopping while the reads of a sample are counted.
+    # every 'interim' reads the normalised matrix is written to output, and each crossover's frequency with its 95% confidence interval is added to a long format progress table next to it.
+    # update() returns True to stop once every interval is narrower than ci_width, checked after each chunk of reads, or max_reads have been read. The chunks end at every interim point and at max_reads (see chunk_limit), so those are exact.
+    def __init__(self, output, interim=0, ci_width=None, max_reads=None, quiet=False):
+        self.output = output
+        self.interim = interim
+        self.ci_width = ci_width
+        self.max_reads = max_reads
+        self.quiet = quiet
+        self.reads = 0
+        self.written = 0
+        self.table = open(os.path.splitext(output)[0]+".progress.csv", "w")
+        self.table.write("Reads,Donor,Acceptor,Frequency,CI.Lower,CI.Upper\n")
+    def chunk_limit(self, handed):
+        # the most reads the next chunk may hold once 'handed' reads have been handed out, so no chunk runs past an interim point or max_reads. None if there is no limit and 0 once max_reads have been handed out.
+        limits = list()
+        if self.interim > 0:
+            limits.append(self.interim - handed % self.interim)
+        if self.max_reads is not None:
+            limits.append(max(0, self.max_reads - handed))
+        if not limits:
+            return(None)
+        return(min(limits))
+    def intervals(self, samp_dict, readcounts, primer_names):
+        # the frequency and interval of each crossover, the crossover reads of a pair out of the readcounts of its two targets as in normalise().
+        cells = list()
+        for donor in primer_names:
+            for acceptor in primer_names:
+                if donor != acceptor:
+                    count = samp_dict[donor+"-"+acceptor] + samp_dict[acceptor+"-"+donor]
+                    total = readcounts[donor] + readcounts[acceptor]
+                    lower, upper = wilson_interval(count, total)
+                    cells.append((donor, acceptor, (count/total)*100 if total > 0 else 0, lower, upper))
+        return(cells)
+    def write(self, samp_dict, readcounts, primer_names, cells):
+        translomap_write(tc_dict=normalise(samp_dict, readcounts, primer_names), tc_output=self.output, names=primer_names)
+        for donor, acceptor, rate, lower, upper in cells:
+            self.table.write(",".join([str(self.reads), donor, acceptor, str(rate), str(lower), str(upper)])+"\n")
+        self.table.flush()
+        self.written = self.reads
+    def update(self, samp_dict, readcounts, primer_names, reads):
+        self.reads += reads
+        self.counts = (samp_dict, readcounts, primer_names)
+        cells = None
+        stop = False
+        if self.max_reads is not None and self.reads >= self.max_reads:
+            stop = True
+            if not self.quiet:
+                print("\nStopping after "+str(self.reads)+" reads, --max_reads (-mr) was reached.\n")
+        if self.ci_width is not None:
+            cells = self.intervals(samp_dict, readcounts, primer_names)
+            if all([upper-lower < self.ci_width for donor, acceptor, rate, lower, upper in cells]):
+                stop = True
+                if not self.quiet:
+                    print("\nStopping after "+str(self.reads)+" reads, every confidence interval is narrower than --ci_width (-w).\n")
+        if stop or (self.interim > 0 and self.reads - self.written >= self.interim):
+            if cells is None:
+                cells = self.intervals(samp_dict, readcounts, primer_names)
+            self.write(samp_dict, readcounts, primer_names, cells)
+        return(stop)
+    def close(self):
+        # the progress table ends with the estimate from every read used.
+        if self.reads > self.written:
+            samp_dict, readcounts, primer_names = self.counts
+            self.write(samp_dict, readcounts, primer_names, self.intervals(samp_dict, readcounts, primer_names))
+        self.table.close()
+def normalise(samp_dict, readcounts, primer_names):
     # Normalise all counts to readcount of the canonical donor target
     samp_dict_norm = {}
     for donor in primer_names:
@@ -331,13 +428,18 @@ def TransloCapture(argues):
             else:
                 samp_dict_norm[donor+"-"+acceptor] = "NA"
     return(samp_dict_norm)
+def TransloCapture(argues):
+    samp_dict, readcounts, primer_names = count_reads(argues)
+    return(normalise(samp_dict, readcounts, primer_names))
 def dict_diff(ctrl_dict, treat_dict):
+    # treated-control for each crossover, matched by name so a crossover missing from the control is NA rather than paired with another.
     diff_dict = {}
-    for (key1,val1), (key2,val2) in zip(sorted(ctrl_dict.items()), sorted(treat_dict.items())):
-        if val1 != "NA":
-            diff_dict[key2] = float(val2)-float(val1)
-        elif val1 == "NA":
-            diff_dict[key2] = val2
+    for key, val2 in treat_dict.items():
+        val1 = ctrl_dict.get(key, "NA")
+        if val1 != "NA" and val2 != "NA":
+            diff_dict[key] = float(val2)-float(val1)
+        else:
+            diff_dict[key] = "NA"
     return(diff_dict)
 def translomap_write(tc_dict="", tc_output="", names=""):
     with open(tc_output, 'w') as outputfile:
@@ -345,16 +447,87 @@ def translomap_write(tc_dict="", tc_output="", names=""):
         for acceptor in names:
             outputfile.write(str(acceptor+","))
             outputfile.write(','.join([str(tc_dict[str(donor+"-"+acceptor)]) for donor in names])+"\n")
+def fastq_unit(fastqs):
+    # a sample sheet entry of one fastq (SR) or read1,read2 (PE) as the (fastq, fastq1, fastq2) passed to TransloCapture.
+    files = fastqs.split(",")
+    if len(files) == 1:
+        return((files[0], None, None))
+    return((None, files[0], files[1]))
+def read_batch(batch):
+    # returns a list of (output, sample, control) from a tab separated sample sheet, samples as fastq_unit and control None if the sample is not normalised.
+    samples = list()
+    with open(batch) as sheet:
+        for sample in sheet:
+            if sample.strip() == "" or sample.startswith("#"):
+                continue
+            columns = sample.rstrip("\r\n").split("\t")
+            if len(columns) < 2 or len(columns[1].split(",")) > 2 or len(columns) > 2 and len(columns[2].split(",")) > 2:
+                print("\nTransloCapture ERROR: Each line of --batch (-bt) needs an output matrix, the fastq (or read1,read2) and optionally the control fastq (or read1,read2), separated by tabs:\n"+sample)
+                sys.exit()
+            control = None
+            if len(columns) > 2 and columns[2] != "":
+                control = fastq_unit(columns[2])
+            samples.append((columns[0], fastq_unit(columns[1]), control))
+    return(samples)
+def count_sample(argues):
+    # counts one fastq (or pair) of a batch, returned with the unit so results can come back in any order.
+    unit=argues[0]
+    samp_dict, readcounts, primer_names = count_reads([unit[0], unit[1], unit[2], argues[1], None, None, None, None, None, None, argues[2], 1, argues[3]])
+    return([unit, samp_dict, readcounts])
+def run_batch(args):
+    # every fastq of the sample sheet is classified once, even if it is the control of many samples, with the fastqs spread over a pool of --threads processes.
+    # the primer index is built here, before the pool is started, so the worker processes share it rather than each reading the primers again.
+    samples = read_batch(args.batch)
+    units = list()
+    for output, sample, control in samples:
+        for unit in [sample, control]:
+            if unit is not None and unit not in units:
+                units.append(unit)
+    for paired in set([unit[1] is not None for unit in units]):
+        primer_panel(args.primers, args.sensitivity, paired, args.max_mismatches)
+    primer_names = read_primers(args.primers, args.sensitivity)[0]
+    if args.quiet == False:
+        print("\nIdentifying translocated sequences in "+str(len(units))+" fastqs.\n")
+    normalised = {}
+    p=Pool(args.threads)
+    for unit, samp_dict, readcounts in p.imap_unordered(count_sample, [[unit, args.primers, args.sensitivity, args.max_mismatches] for unit in units]):
+        normalised[unit] = normalise(samp_dict, readcounts, primer_names)
+        if args.quiet == False:
+            print(",".join([fastq for fastq in unit if fastq is not None]))
+    p.close()
+    p.join()
+    if args.quiet == False:
+        print("\nQuantifying differentials and writing output files.\n")
+    # each matrix is written as usual, and all of them together to --output as a long format table.
+    with open(args.output, "w") as table:
+        table.write("Sample,Donor,Acceptor,Frequency\n")
+        for output, sample, control in samples:
+            if control is None:
+                tc_dict = normalised[sample]
+            else:
+                tc_dict = dict_diff(normalised[control], normalised[sample])
+            translomap_write(tc_dict=tc_dict, tc_output=output, names=primer_names)
+            for acceptor in primer_names:
+                for donor in primer_names:
+                    table.write(",".join([output, donor, acceptor, str(tc_dict[donor+"-"+acceptor])])+"\n")
 def main(args=argypargy()):
+    if args.batch is not None:
+        run_batch(args)
+        return
     if args.preproc == False:
         with open(args.primers) as sites:
             primer_names = [site.split(",")[0] for site in sites]
         if args.control is not None or args.control1 is not None:
             if args.quiet == False:
                 print("\nIdentifying translocated sequences in treated and control.\n")
-            p=Pool(2)
-            both_dicts=p.map(TransloCapture, [[args.control, args.control1, args.control2, args.primers, args.translocated, None, None, args.fastqout, None, None, args.sensitivity], [args.input, args.read1, args.read2, args.primers, args.translocated, args.translocated1, args.translocated2, args.fastqout, args.fastqout1, args.fastqout2, args.sensitivity]])
-            p.close()
+            samples = [[args.control, args.control1, args.control2, args.primers, args.translocated, None, None, args.fastqout, None, None, args.sensitivity, args.threads, args.max_mismatches], [args.input, args.read1, args.read2, args.primers, args.translocated, args.translocated1, args.translocated2, args.fastqout, args.fastqout1, args.fastqout2, args.sensitivity, args.threads, args.max_mismatches, None, args.junctions, args.top_junctions]]
+            if args.threads > 1:
+                # each sample is split across all the threads in turn.
+                both_dicts = [TransloCapture(sample) for sample in samples]
+            else:
+                p=Pool(2)
+                both_dicts=p.map(TransloCapture, samples)
+                p.close()
             if args.quiet == False:
                 print("\nQuantifying differential and writing output file.\n")
             diff_dict = dict_diff(both_dicts[0], both_dicts[1])
@@ -362,27 +535,24 @@ def main(args=argypargy()):
         else:
             if args.quiet == False:
                 print("\nIdentifying translocated sequences.\n")
-            treat_dict = TransloCapture([args.input, args.read1, args.read2, args.primers, args.translocated, args.translocated1, args.translocated2, args.fastqout, args.fastqout1, args.fastqout2, args.sensitivity])
+            progress = None
+            if args.interim > 0 or args.ci_width is not None or args.max_reads is not None:
+                progress = Progress(args.output, interim=args.interim, ci_width=args.ci_width, max_reads=args.max_reads, quiet=args.quiet)
+            treat_dict = TransloCapture([args.input, args.read1, args.read2, args.primers, args.translocated, args.translocated1, args.translocated2, args.fastqout, args.fastqout1, args.fastqout2, args.sensitivity, args.threads, args.max_mismatches, progress, args.junctions, args.top_junctions])
             translomap_write(tc_dict=treat_dict, tc_output=args.output, names=primer_names)
     elif args.preproc == True:
         if args.quiet == False:
             print("\nQuantifying differential and writing output file.\n")
-        with open(args.control) as ctrl, open(args.input) as treat, open(args.output, "w") as outputfile:
-            outputfile.write(",")
-            for line1, line2 in zip(ctrl, treat):
-                lengt=len(line1.split(","))
-                count=0
-                for val1, val2 in zip(line1.split(","), line2.split(",")):
-                    count+=1
-                    if val1 or val2:
-                        if count == lengt:
-                            extra=""
-                        else:
-                            extra=","
-                        if numsafe(val1) and numsafe(val2):
-                            outputfile.write(str(float(val2)-float(val1))+extra)
-                        else:
-                            outputfile.write(val1.strip("\n")+extra)
-                outputfile.write("\n")
+        # several treated matrices can be diffed against the one control, given as comma separated --input (-i) and --output (-o) lists.
+        treated = args.input.split(",")
+        outputs = args.output.split(",")
+        try:
+            missing = diff_matrices(args.control, treated, outputs)
+        except ValueError as error:
+            print("\nTransloCapture ERROR: "+str(error)+"\n")
+            sys.exit()
+        for treated_path, targets in zip(treated, missing):
+            if targets and args.quiet == False:
+                print("\nTransloCapture WARNING: "+",".join(targets)+" of "+treated_path+" are not in the control matrix and are NA in the differential.\n")
 
 
@@ -0,0 +1,246 @@
+# Binary companion format for mprofiles (.mprofb).
+# Every mprofile column is stored as a fixed-width array, so a profile is memory-mapped and its columns are used directly without parsing any text.
+# Layout: magic, 8 byte header length, JSON header (row count, chromosome row ranges, column offsets and the interned indel sequences), then each column array aligned to 8 bytes.
+# Common.Indels is stored as three arrays: indel_offsets gives the slice of indel_ids/indel_rates for each row, indel_ids index into the header's indel table.
+import sys
+from sys import intern
+import json
+import mmap
+from array import array
+from bisect import bisect_left, bisect_right
+from mProfile.fileio import open_input, open_output
+from mProfile.regions import merge_regions, region_lines
+
+
+
+magic = b"MPROFB1\n"
+mprofile_header = "Chromosome\tCoordinate\tRef.Base\tReadcount\tA.Mutations\tT.Mutations\tG.Mutations\tC.Mutations\tTransitions\tTransversions\tTotal.SNVs\tInsertions\tDeletions\tSmall.Indels\tMid.Indels\tLarge.Indels\tCommon.Indels\n"
+rate_columns = ["A.Mutations", "T.Mutations", "G.Mutations", "C.Mutations", "Transitions", "Transversions", "Total.SNVs", "Insertions", "Deletions", "Small.Indels", "Mid.Indels", "Large.Indels"]
+
+def is_binary(path):
+    if path == "-":
+        return(False)
+    with open(path, "rb") as profile:
+        return(profile.read(len(magic)) == magic)
+def parse_indels(common_indels):
+    # splits a Common.Indels field (e.g. +1T:0.02,-2AG:0.001,) into a list of (indel sequence, rate).
+    indels = list()
+    for indel in common_indels.strip().split(","):
+        if indel != "":
+            sequence, rate = indel.rsplit(":", 1)
+            indels.append((intern(sequence), float(rate)))
+    return(indels)
+class ProfileColumns(object):
+    # row access shared by profiles held in memory (MemoryProfile) and memory-mapped from a .mprofb file (BinaryProfile).
+    # subclasses provide rows, chromosomes ([name, first row, last row] ranges), indel_table and the columns dict of arrays/memoryviews.
+    def __enter__(self):
+        return(self)
+    def __exit__(self, *exc):
+        self.close()
+    def __len__(self):
+        return(self.rows)
+    def close(self):
+        pass
+    def chromosome(self, row):
+        for name, first, last in self.chromosomes:
+            if first <= row < last:
+                return(name)
+    def region(self, chr, start=None, end=None):
+        # returns the (first, last) rows, last exclusive, covering coordinates start-end (1-based and inclusive, as in the mprofile) of chr.
+        # coordinates are sorted within a chromosome, so this is a binary search on the coordinate column.
+        coordinates = self.columns["Coordinate"]
+        for name, first, last in self.chromosomes:
+            if name == chr:
+                if start is not None:
+                    first = bisect_left(coordinates, start, first, last)
+                if end is not None:
+                    last = bisect_right(coordinates, end, first, last)
+                return(first, last)
+        return(0, 0)
+    def indels(self, row):
+        # the Common.Indels of a row as a list of (indel sequence, rate).
+        offsets = self.columns["indel_offsets"]
+        ids = self.columns["indel_ids"]
+        rates = self.columns["indel_rates"]
+        return([(self.indel_table[ids[i]], rates[i]) for i in range(offsets[row], offsets[row+1])])
+    def line(self, row, name=None):
+        # a row as an mprofile line, name is the chromosome if it is already known.
+        if name is None:
+            name = self.chromosome(row)
+        columns = self.columns
+        fields = [name, str(columns["Coordinate"][row]), chr(columns["Ref.Base"][row]), str(columns["Readcount"][row])]
+        fields += [str(columns[column][row]) for column in rate_columns]
+        fields.append("".join([sequence+":"+str(rate)+"," for sequence, rate in self.indels(row)]))
+        return("\t".join(fields)+"\n")
+    def lines(self, first=0, last=None):
+        # yields the rows first-last as mprofile lines.
+        if last is None:
+            last = self.rows
+        for name, chr_first, chr_last in self.chromosomes:
+            for row in range(max(first, chr_first), min(last, chr_last)):
+                yield(self.line(row, name=name))
+class MemoryProfile(ProfileColumns):
+    # mprofile rows collected into column arrays in memory, e.g. when reading a text mprofile. save() writes them as a .mprofb file.
+    # write() takes mprofile text (any number of lines, header included) so it can be used in place of an output file.
+    def __init__(self):
+        self.columns = {"Coordinate": array("q"), "Ref.Base": array("B"), "Readcount": array("q")}
+        for column in rate_columns:
+            self.columns[column] = array("d")
+        self.rates = [self.columns[column] for column in rate_columns]
+        self.indel_fields = list()
+        self.indel_table = list()
+        self.chromosomes = list()
+        self.rows = 0
+        self.partial = ""
+    def write(self, text):
+        lines = (self.partial+text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.add_line(line)
+        return(len(text))
+    def add_line(self, line):
+        if line.strip() == "" or line.startswith("Chromosome\t"):
+            return
+        self.add_row(line.rstrip("\r\n").split("\t"))
+    def add_row(self, columns):
+        row = self.rows
+        # rows of a chromosome are contiguous in an mprofile, a new range is only started when the chromosome changes.
+        if not self.chromosomes or self.chromosomes[-1][0] != columns[0]:
+            self.chromosomes.append([columns[0], row, row])
+        self.chromosomes[-1][2] = row+1
+        self.columns["Coordinate"].append(int(columns[1]))
+        self.columns["Ref.Base"].append(ord(columns[2][:1] or "N"))
+        self.columns["Readcount"].append(int(columns[3]))
+        for rates, rate in zip(self.rates, columns[4:16]):
+            rates.append(float(rate))
+        # Common.Indels is kept as text until it is needed, it is only split into the indel table when saving.
+        self.indel_fields.append(columns[16].strip() if len(columns) > 16 else "")
+        self.rows += 1
+    def append_row(self, row):
+        # adds a row that is already split into values, as returned by callMUT.mutation_rates: [chr, coordinate, base, readcount, [12 rates], [(indel sequence, rate), ...]].
+        if not self.chromosomes or self.chromosomes[-1][0] != row[0]:
+            self.chromosomes.append([row[0], self.rows, self.rows])
+        self.chromosomes[-1][2] = self.rows+1
+        self.columns["Coordinate"].append(int(row[1]))
+        self.columns["Ref.Base"].append(ord(row[2][:1] or "N"))
+        self.columns["Readcount"].append(row[3])
+        for rates, rate in zip(self.rates, row[4]):
+            rates.append(rate)
+        self.indel_fields.append(row[5])
+        self.rows += 1
+    def indels(self, row):
+        # indel_fields holds Common.Indels text for rows read from an mprofile and lists of (indel sequence, rate) for rows added with append_row.
+        indels = self.indel_fields[row]
+        if isinstance(indels, str):
+            return(parse_indels(indels))
+        return(indels)
+    def index_indels(self):
+        # fills the indel_offsets/indel_ids/indel_rates arrays and the table of unique indel sequences from the Common.Indels text.
+        indel_offsets = array("q", [0])
+        indel_ids = array("i")
+        indel_rates = array("d")
+        indel_index = {}
+        self.indel_table = list()
+        for row in range(self.rows):
+            indels = self.indels(row)
+            if indels:
+                for sequence, rate in indels:
+                    if sequence not in indel_index:
+                        indel_index[sequence] = len(self.indel_table)
+                        self.indel_table.append(sequence)
+                indel_ids.extend([indel_index[sequence] for sequence, rate in indels])
+                indel_rates.extend([rate for sequence, rate in indels])
+            indel_offsets.append(len(indel_ids))
+        self.columns["indel_offsets"] = indel_offsets
+        self.columns["indel_ids"] = indel_ids
+        self.columns["indel_rates"] = indel_rates
+    def save(self, path):
+        if self.partial:
+            self.add_line(self.partial)
+            self.partial = ""
+        self.index_indels()
+        arrays = [(name, self.columns[name]) for name in ["Coordinate", "Ref.Base", "Readcount"]+rate_columns+["indel_offsets", "indel_ids", "indel_rates"]]
+        # the column offsets depend on the header length, so the header is laid out again until its length (and so the offsets) stop changing.
+        columns = {}
+        header = b""
+        header_length = -1
+        while len(header) != header_length:
+            header_length = len(header)
+            offset = len(magic) + 8 + header_length
+            for name, values in arrays:
+                offset += -offset % 8
+                columns[name] = [offset, values.typecode, len(values)]
+                offset += len(values)*values.itemsize
+            header = json.dumps({"rows": self.rows, "byteorder": sys.byteorder, "chromosomes": self.chromosomes, "columns": columns, "indel_table": self.indel_table}).encode()
+            header += b" "*(-len(header) % 8)
+        with open(path, "wb") as binfile:
+            binfile.write(magic)
+            binfile.write(len(header).to_bytes(8, "little"))
+            binfile.write(header)
+            for name, values in arrays:
+                binfile.write(b"\0"*(columns[name][0]-binfile.tell()))
+                values.tofile(binfile)
+class BinaryWriter(MemoryProfile):
+    # a MemoryProfile used in place of an output file, written to path as a .mprofb file when closed.
+    def __init__(self, path):
+        MemoryProfile.__init__(self)
+        self.path = path
+    def close(self):
+        self.save(self.path)
+class BinaryProfile(ProfileColumns):
+    # read-only, memory-mapped access to a .mprofb file. columns[name] are memoryviews straight onto the file, no data is copied or parsed when opening.
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        if self.file.read(len(magic)) != magic:
+            self.file.close()
+            raise ValueError(path+" is not a binary mprofile (.mprofb).")
+        header_length = int.from_bytes(self.file.read(8), "little")
+        header = json.loads(self.file.read(header_length).decode())
+        if header["byteorder"] != sys.byteorder:
+            self.file.close()
+            raise ValueError(path+" was written on a "+header["byteorder"]+" endian machine and cannot be memory-mapped on this one.")
+        self.rows = header["rows"]
+        self.chromosomes = header["chromosomes"]
+        self.indel_table = header["indel_table"]
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        self.columns = {}
+        for name, (offset, typecode, count) in header["columns"].items():
+            self.columns[name] = view[offset:offset+count*array(typecode).itemsize].cast(typecode)
+        view.release()
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.map.close()
+        self.file.close()
+def load_profile(mprofile, regions=None):
+    # opens a binary mprofile with a memory map, or reads a text mprofile into a MemoryProfile.
+    # regions, a list of bed style (chromosome, start, end), keeps only those rows, which are copied into a MemoryProfile.
+    if is_binary(mprofile):
+        if regions is None:
+            return(BinaryProfile(mprofile))
+        profile = MemoryProfile()
+        with BinaryProfile(mprofile) as binary:
+            order = dict((chromosome[0], i) for i, chromosome in enumerate(binary.chromosomes))
+            for name, start, end in sorted([region for region in merge_regions(regions) if region[0] in order], key=lambda region: order[region[0]]):
+                first, last = binary.region(name, start+1, end)
+                for line in binary.lines(first, last):
+                    profile.add_line(line)
+        return(profile)
+    profile = MemoryProfile()
+    if regions is None:
+        with open_input(mprofile) as tsv:
+            for line in tsv:
+                profile.add_line(line)
+    else:
+        for line in region_lines(mprofile, regions):
+            profile.add_line(line)
+    return(profile)
+def mprofile_to_binary(mprofile, binary, regions=None):
+    load_profile(mprofile, regions=regions).save(binary)
+def binary_to_mprofile(binary, mprofile, regions=None):
+    with load_profile(binary, regions=regions) as profile, open_output(mprofile) as tsv:
+        tsv.write(mprofile_header)
+        for line in profile.lines():
+            tsv.write(line)
@@ -0,0 +1,72 @@
+# Clustering of StructureMap's aberrant pairs into structural variant events.
+# Pairs supporting the same event have the same contigs, strands and aberration, and both of their reads lie within about a fragment size of the other pairs'.
+# Each breakpoint interval is kept within one window, so a run of unrelated aberrant pairs (e.g. background noise) cannot chain into one ever-growing event.
+# Rows arrive sorted by the forward read (the first read of each pair), so clusters are built in one sweep: a cluster stays open until the sweep is more than a window past its first pair, and only the open clusters of the same kind are compared to each new pair.
+
+
+
+event_header = "Chr FW\tStart FW\tEnd FW\tChr RV\tStart RV\tEnd RV\tStrand FW\tStrand RV\tAbberation\tPairs\n"
+
+class RowRecords(list):
+    # collects rows with the same add() as EventClusters, so a worker process can hand its rows back to be clustered in genome order.
+    def add(self, *row):
+        self.append(row)
+class EventClusters(object):
+    # groups the rows added (with the arguments of SprofileRows.add) into events, written to path as each contig is finished.
+    # a pair joins the first open cluster of its kind whose first forward read is within 'window' of its forward read and whose reverse reads would still span no more than 'window' with its reverse read. Events with fewer than min_support pairs are not written.
+    def __init__(self, path, contigs, window=2000, min_support=2):
+        self.contigs = contigs
+        self.window = window
+        self.min_support = min_support
+        self.open = {}
+        self.done = list()
+        self.ref = None
+        self.events = 0
+        self.file = open(path, "w")
+        self.file.write(event_header)
+    def add(self, ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, insert, aberration, flag):
+        if ref_x != self.ref:
+            self.flush()
+            self.ref = ref_x
+        window = self.window
+        key = (ref_y, strand_x, strand_y, aberration)
+        clusters = self.open.get(key)
+        if clusters is None:
+            self.open[key] = [[coord_x, coord_x, coord_y, coord_y, 1]]
+            return
+        for cluster in clusters:
+            if coord_x-cluster[0] <= window and max(cluster[3], coord_y)-min(cluster[2], coord_y) <= window:
+                cluster[1] = coord_x
+                if coord_y < cluster[2]:
+                    cluster[2] = coord_y
+                elif coord_y > cluster[3]:
+                    cluster[3] = coord_y
+                cluster[4] += 1
+                return
+        # a new cluster is started, and the clusters of this kind the sweep has passed are finished.
+        still_open = list()
+        for cluster in clusters:
+            if coord_x-cluster[0] > window:
+                self.finish(key, cluster)
+            else:
+                still_open.append(cluster)
+        still_open.append([coord_x, coord_x, coord_y, coord_y, 1])
+        self.open[key] = still_open
+    def finish(self, key, cluster):
+        if cluster[4] >= self.min_support:
+            self.done.append((cluster[0], cluster[1], key[0], cluster[2], cluster[3], key[1], key[2], key[3], cluster[4]))
+    def flush(self):
+        # finishes every cluster of the current contig and writes its events in order of position.
+        for key, clusters in self.open.items():
+            for cluster in clusters:
+                self.finish(key, cluster)
+        self.open = {}
+        if self.ref is not None:
+            chr_x = self.contigs[self.ref]
+            for start_x, end_x, ref_y, start_y, end_y, strand_x, strand_y, aberration, pairs in sorted(self.done):
+                self.file.write("\t".join([chr_x, str(start_x), str(end_x), self.contigs[ref_y], str(start_y), str(end_y), strand_x, strand_y, aberration, str(pairs)])+"\n")
+            self.events += len(self.done)
+        self.done = list()
+    def close(self):
+        self.flush()
+        self.file.close()
@@ -2,41 +2,92 @@
 from __future__ import division
 from argparse import ArgumentParser
 import sys
-from re import sub, findall, finditer
+from sys import intern
+import os
+from tempfile import mkstemp
+from re import sub, compile
 from multiprocessing import Pool
+from array import array
+from mProfile.fileio import open_input, open_output
+from mProfile.parallel import batch_lines, ordered_map
+from mProfile.regions import parse_region, read_bed, merge_regions, region_lines
+from mProfile.binprofile import BinaryWriter, BinaryProfile, MemoryProfile, is_binary, load_profile, parse_indels, rate_columns, mprofile_to_binary, binary_to_mprofile, mprofile_header
+from operator import sub as subtract
 try:
     from itertools import izip as zip
 except ImportError:
     pass
 
 
+# digits in the read bases only ever occur as the length of an indel, e.g. +2AG or -1t.
+indel_number = compile(r'\d+')
 
 def argypargy():
     parser = ArgumentParser(description="callMUT -i input.mpileup -o output.mprofile")
     req_args = parser.add_argument_group('Required arguments')
     add_args = parser.add_argument_group('Additional arguments')
-    req_args.add_argument("--input", "-i", help="Input mpileup or mprofile to process.")
-    req_args.add_argument("--output", "-o", help="Output mprofile.")
+    req_args.add_argument("--input", "-i", help="Input mpileup or mprofile to process, can be gzip/bgzip compressed or '-' for stdin.")
+    req_args.add_argument("--output", "-o", help="Output mprofile, gzip compressed if it ends with .gz, binary if it ends with .mprofb or '-' for stdout.")
     add_args.add_argument("--indelcut", "-ic", help="Minimum rate for an indel's sequence to be reported, default=1, If 'NA', no cutoff will be applied.", nargs='?', default=1)
     add_args.add_argument("--control", "-c", help="mpileup/mprofile to normalise to (e.g. untreated).")
     add_args.add_argument("--preproc", "-pp", help="Specifies input files are mprofiles, not mpileups (requires --control to be set).", action='store_true')
     add_args.add_argument("--small", "-sl", help="Length classification for small indels, default=1 i.e. length<=1.", nargs='?', default=1)
     add_args.add_argument("--mid", "-ml", help="Length classification for mid indels, default=2,4 i.e. 2<=length<=4.", nargs='?', default="2,4")
     add_args.add_argument("--large", "-ll", help="Length classification for large indels, default=5 i.e. 5<=length.", nargs='?', default=5)
+    add_args.add_argument("--threads", "-t", help="Number of processes used to convert mpileups, default=1.", nargs='?', default=1)
+    add_args.add_argument("--batch", "-bt", help="Tab separated file of treated mpileups/mprofiles and their output mprofile (one pair per line), each is compared to the same --control (-c), which is only processed once.")
+    add_args.add_argument("--convert", "-cv", help="Converts --input between an mprofile and a binary mprofile (.mprofb), the direction is set by the --output (-o) extension.", action='store_true')
+    add_args.add_argument("--bam", "-b", help="Specifies --input (-i) and --control (-c) are indexed BAM/CRAM files, which are piled up directly instead of reading an mpileup (requires --bed and --reference).", action='store_true')
+    add_args.add_argument("--bed", "-r", help="Bed file of the regions (e.g. amplicons) to process, only these are read from the input and control files or piled up with --bam (-b).")
+    add_args.add_argument("--region", "-g", help="Region to process as chr:start-end (1-based, inclusive) or a whole chromosome, can be given more than once and alongside --bed (-r).", action='append')
+    add_args.add_argument("--reference", "-f", help="Reference fasta (indexed) used with --bam (-b) for the reference bases and to decode CRAM files.")
+    add_args.add_argument("--min_bq", "-Q", help="Minimum base quality for a base to be counted with --bam (-b), default=13 as in samtools mpileup.", nargs='?', default=13)
+    add_args.add_argument("--max_depth", "-d", help="Maximum reads per position with --bam (-b), default=0 i.e. no limit.", nargs='?', default=0)
     add_args.add_argument("--quiet", "-q", help="Removes all messages.")
     args = parser.parse_args()
     if len(sys.argv)==1:
         parser.print_help()
         sys.exit()
-    if args.input is None and args.read1 is None:
+    if args.input is None and args.batch is None:
         print("\ncallMUT ERROR: Please provide an input file with --input (-i).\n")
         sys.exit()
-    if args.output is None:
+    if args.output is None and args.batch is None:
         print("\ncallMUT ERROR: Please provide an output file with --output (-o).\n")
         sys.exit()
+    if args.batch is not None and (args.input is not None or args.output is not None):
+        print("\ncallMUT ERROR: --batch (-bt) lists the input and output files, it cannot be used alongside --input (-i) or --output (-o).\n")
+        sys.exit()
+    if args.batch is not None and args.control is None:
+        print("\ncallMUT ERROR: --batch (-bt) also needs --control (-c) to calculate a differential to each sample.\n")
+        sys.exit()
     if args.preproc == True and args.control is None:
         print("\ncallMUT ERROR: --preproc (-pp) also needs --control (-c) to calculate a differential to the --input (-i) sample.\n")
         sys.exit()
+    if args.bam == True and args.preproc == True:
+        print("\ncallMUT ERROR: --bam (-b) and --preproc (-pp) cannot be used together, mprofiles are not alignment files.\n")
+        sys.exit()
+    if args.bam == True and ((args.bed is None and args.region is None) or args.reference is None):
+        print("\ncallMUT ERROR: --bam (-b) also needs --bed (-r) or --region (-g) for the regions to pile up and --reference (-f) for the reference bases.\n")
+        sys.exit()
+    # --region and --bed are combined into one list of bed style (chromosome, start, end) regions, None reads the whole file.
+    args.regions = None
+    if args.bed is not None or args.region is not None:
+        args.regions = list()
+        if args.bed is not None:
+            args.regions += read_bed(args.bed)
+        try:
+            args.regions += [parse_region(region) for region in (args.region or [])]
+        except ValueError:
+            print("\ncallMUT ERROR: --region (-g) should be chr:start-end or a chromosome name.\n")
+            sys.exit()
+        args.regions = merge_regions(args.regions)
+    try:
+        args.min_bq=int(args.min_bq)
+        args.max_depth=int(args.max_depth)
+    except ValueError:
+        print("\nMinimum base quality or maximum depth is not a valid number, running as default (13 and 0).\n")
+        args.min_bq = 13
+        args.max_depth = 0
     try:
         args.small=float(args.small)
     except ValueError:
@@ -53,6 +104,14 @@ def argypargy():
     except ValueError:
         print("\nLarge indel length is not a valid number, running as default (5).\n")
         args.large = 5
+    try:
+        args.threads=int(args.threads)
+    except ValueError:
+        print("\nThreads is not a valid number, running as default (1).\n")
+        args.threads = 1
+    if args.threads < 1:
+        print("\nThreads must be at least 1, running as default (1).\n")
+        args.threads = 1
     if args.indelcut != "NA":
         try:
             args.indelcut=float(args.indelcut)
@@ -60,7 +119,29 @@ def argypargy():
             print("\nIndel cutoff is not a valid number, running without a cutoff.\n")
             args.indelcut = "NA"
     return(args)
-def de_indel(argues):
+def tally_pileup(reads):
+    # walk the mpileup read bases once, jumping from one indel to the next rather than rebuilding the string for every indel found.
+    # returns the read bases with the indel sequences removed, the list of indel lengths and a dict of the upper-case indel sequences (e.g. +1T) and their counts.
+    # indel sequences are interned, so the same indel seen at many positions or in both samples is stored once.
+    kept = list()
+    lengths = list()
+    indel_counts = {}
+    pos = 0
+    match = indel_number.search(reads)
+    while match is not None:
+        start, end = match.span()
+        length = int(match.group())
+        indel = intern(reads[start-1:end+length].upper())
+        indel_counts[indel] = indel_counts.get(indel, 0) + 1
+        lengths.append(length)
+        kept.append(reads[pos:end])
+        pos = end + length
+        match = indel_number.search(reads, pos)
+    kept.append(reads[pos:])
+    return(''.join(kept), lengths, indel_counts)
+def mutation_rates(argues):
+    # the mutation rates of one mpileup line as a row: [chr, coordinate, base, readcount, [the 12 rates], [(indel sequence, rate), ...]].
+    # indels at or below the cutoff are dropped here, before anything is formatted.
     mpileup_base = argues[0]
     cutoff = argues[1]
     sml_len = argues[2]
@@ -72,47 +153,23 @@ def de_indel(argues):
     coordinate = columns[1]
     base = columns[2]
     readcount = int(columns[3])
-    reads = sub('\\^.', "", columns[4])
-    startlocations = list()
-    endlocations = list()
-    length_diff = 0
-    indel_sequences = ""
     # indels must first be extracted from the mpileup mutation calls, as it reports indel sequences which interferes with point mutation counting. 
-    # use regex to find and extract the string of the indel number (findall) as well as the match object for the indel (finditer).
     if readcount>0:
-        indels = findall(r'\d+', reads)
-        # use the match objects to create a list of locations for each match.
-        for match in finditer(r'\d+', reads):
-            startlocations.append(int(match.start()))
-            endlocations.append(int(match.end()))
-        # iterate over the list of indel strings and their locations simultaneously to remove the sequences and generate a new string containing just the indels (indel_sequences).
-        # the length difference is calculated to account for the removal of each indel shortening the sequence and therefore altering the position of the indels.
-        for startlocation, endlocation, indel in zip(startlocations, endlocations, indels):
-            if indel != '':
-                indel_sequences = indel_sequences+(reads[(startlocation-1-length_diff):(endlocation+int(indel)-length_diff)]).upper()+","
-                oldlength = len(reads)
-                reads = reads[:(endlocation-length_diff)] + reads[(endlocation + int(indel) - length_diff):]
-                newlength = len(reads)
-                length_diff = length_diff + (oldlength - newlength)
+        reads, lengths, indel_counts = tally_pileup(sub('\\^.', "", columns[4]))
         # calculate the mutation rates.
-        formatted_indels = ""
-        for indel in set(indel_sequences.split(",")):
-            if indel != '':
-                rate = (indel_sequences.count(indel)/readcount)*100
-                if str(cutoff).upper() != "NA":
-                    if rate > float(cutoff):
-                        formatted_indels = formatted_indels+(indel+":"+str(rate)+",")
-                else:
-                    formatted_indels = formatted_indels+(indel+":"+str(rate)+",")
-        a_rate = (reads.upper().count("A")/readcount)*100
-        t_rate = (reads.upper().count("T")/readcount)*100
-        g_rate = (reads.upper().count("G")/readcount)*100
-        c_rate = (reads.upper().count("C")/readcount)*100
+        indels = [(indel, (count/readcount)*100) for indel, count in indel_counts.items()]
+        if str(cutoff).upper() != "NA":
+            indels = [(indel, rate) for indel, rate in indels if rate > float(cutoff)]
+        upper_reads = reads.upper()
+        a_rate = (upper_reads.count("A")/readcount)*100
+        t_rate = (upper_reads.count("T")/readcount)*100
+        g_rate = (upper_reads.count("G")/readcount)*100
+        c_rate = (upper_reads.count("C")/readcount)*100
         in_rate = (reads.count("+")/readcount)*100
         del_rate = (reads.count("-")/readcount)*100
-        sml_rate = (sum(int(indel) <= sml_len for indel in indels)/readcount)*100
-        mid_rate = (sum(mid_len1 <= int(indel) <= mid_len2 for indel in indels)/readcount)*100
-        lrg_rate = (sum(int(indel) >= lrg_len for indel in indels)/readcount)*100
+        sml_rate = (sum(length <= sml_len for length in lengths)/readcount)*100
+        mid_rate = (sum(mid_len1 <= length <= mid_len2 for length in lengths)/readcount)*100
+        lrg_rate = (sum(length >= lrg_len for length in lengths)/readcount)*100
         snv_rate = a_rate + t_rate + g_rate + c_rate
         if base == "G":
             transition = a_rate
@@ -139,94 +196,280 @@ def de_indel(argues):
         sml_rate = 0
         mid_rate = 0
         lrg_rate = 0
-        formatted_indels = ""
+        indels = list()
+    return([chr, coordinate, base, readcount, [a_rate, t_rate, g_rate, c_rate, transition, transversion, snv_rate, in_rate, del_rate, sml_rate, mid_rate, lrg_rate], indels])
+def format_row(row):
     # return a string of the mutation rates that is ready for writing to an output file.
-    return(('\t'.join([chr, coordinate, base, str(readcount), str(a_rate), str(t_rate), str(g_rate), str(c_rate), str(transition), str(transversion), str(snv_rate), str(in_rate), str(del_rate), str(sml_rate), str(mid_rate), str(lrg_rate), formatted_indels]))+"\n")
-def mutDIFF(ctrl_mprofile, treated_mprofile, cutoff="NA"):
-    ctrl_columns = ctrl_mprofile.split("\t")
-    treat_columns = treated_mprofile.split("\t")
-    # take the minimum of the two readcoutns as this dictates the resolution of the mutation calling.
-    rcount_c = int(ctrl_columns[3])
-    rcount_t = int(treat_columns[3])
-    readcount = min(rcount_c, rcount_t)
-    # calculate the differential in the mtuation rates betwee the two samples. 
-    a_rate = float(treat_columns[4]) - float(ctrl_columns[4])
-    t_rate = float(treat_columns[5]) - float(ctrl_columns[5])
-    g_rate = float(treat_columns[6]) - float(ctrl_columns[6])
-    c_rate = float(treat_columns[7]) - float(ctrl_columns[7])
-    transitions = float(treat_columns[8]) - float(ctrl_columns[8])
-    transversions = float(treat_columns[9]) - float(ctrl_columns[9])
-    snv_rate = float(treat_columns[10]) - float(ctrl_columns[10])
-    in_rate = float(treat_columns[11]) - float(ctrl_columns[11])
-    del_rate = float(treat_columns[12]) - float(ctrl_columns[12])
-    sml_rate = float(treat_columns[13]) - float(ctrl_columns[13])
-    mid_rate = float(treat_columns[14]) - float(ctrl_columns[14])
-    lrg_rate = float(treat_columns[15]) - float(ctrl_columns[15])
-
-    # for common indel sequences, first create a dictionary of the control indels (key=indel sequence, value=rate).
-    ctrl_indels = {indel.split(":")[0]:indel.split(":")[1] for indel in ctrl_columns[16].split(",") if indel != "\n"}
-    ctrlkeys = set(ctrl_indels.keys())
-    treatkeys = set()
-    formatted_indels = ""
+    return('\t'.join([row[0], row[1], row[2], str(row[3])]+[str(rate) for rate in row[4]]+[''.join([indel+":"+str(rate)+"," for indel, rate in row[5]])])+"\n")
+def de_indel(argues):
+    return(format_row(mutation_rates(argues)))
+def de_indel_batch(argues):
+    # convert a whole batch of mpileup lines in one task, so worker processes are not paying the pickling and scheduling cost for every line.
+    lines = argues[0]
+    return(''.join([de_indel([mpileup_base]+argues[1:]) for mpileup_base in lines]))
+def diff_batch(argues):
+    # convert a batch of paired control and treated mpileup lines and calculate the treated-control differential of each pair.
+    pairs = argues[0]
+    cutoff = argues[1]
+    lengths = argues[2:]
+    return(''.join([format_row(row_diff(mutation_rates([ctrl, "NA"]+lengths), mutation_rates([treated, "NA"]+lengths), cutoff=cutoff)) for ctrl, treated in pairs]))
+def mutation_rates_batch(argues):
+    lines = argues[0]
+    return([mutation_rates([mpileup_base]+argues[1:]) for mpileup_base in lines])
+def pair_size(pair):
+    return(len(pair[0])+len(pair[1]))
+def indel_diff(ctrl_indels, treat_indels, cutoff="NA"):
+    # calculates the differential of two lists of (indel sequence, rate), returned as a list of (indel sequence, rate) above the cutoff.
     # for each indel in the treated sample, see if the same indel is in the control and if it is, calculate the rate differential between the two samples.
     # if it is in the treated, but not the control, then the treated rate is kept as it is.
-    # if it is in control but n ot that treated, then the treated value is 0 
-    for indel in treat_columns[16].split(","):
-        indelkey = indel.split(":")[0]
-        treatkeys.add(indelkey)
-        if indelkey in ctrlkeys:  
-            rate = float(indel.split(":")[1]) - float(ctrl_indels[indelkey])
-            new_indel = indelkey+":"+str(rate)
+    # if it is in control but not the treated, then the treated value is 0 
+    ctrl_rates = dict(ctrl_indels)
+    treatkeys = set()
+    indels = list()
+    for indel, rate in treat_indels:
+        treatkeys.add(indel)
+        if indel in ctrl_rates:
+            rate = rate - ctrl_rates[indel]
+        if str(cutoff).upper() == "NA" or rate > float(cutoff):
+            indels.append((indel, rate))
+    for indel, rate in ctrl_rates.items():
+        if indel not in treatkeys:
+            rate = 0 - rate
+            if str(cutoff).upper() == "NA" or rate > float(cutoff):
+                indels.append((indel, rate))
+    return(indels)
+def parse_row(mprofile):
+    # splits an mprofile line into the same row as mutation_rates returns.
+    columns = mprofile.rstrip("\r\n").split("\t")
+    return([columns[0], columns[1], columns[2], int(columns[3]), [float(rate) for rate in columns[4:16]], parse_indels(columns[16] if len(columns) > 16 else "")])
+def row_diff(ctrl_row, treat_row, cutoff="NA"):
+    # take the minimum of the two readcounts as this dictates the resolution of the mutation calling.
+    readcount = min(ctrl_row[3], treat_row[3])
+    # calculate the differential in the mutation rates between the two samples.
+    rates = [float(treat_rate) - float(ctrl_rate) for ctrl_rate, treat_rate in zip(ctrl_row[4], treat_row[4])]
+    # the common indel sequences are compared separately, see indel_diff.
+    indels = indel_diff(ctrl_row[5], treat_row[5], cutoff=cutoff)
+    return([ctrl_row[0], ctrl_row[1], ctrl_row[2], readcount, rates, indels])
+def mutDIFF(ctrl_mprofile, treated_mprofile, cutoff="NA"):
+    return(format_row(row_diff(parse_row(ctrl_mprofile), parse_row(treated_mprofile), cutoff=cutoff)))
+def join_rows(ctrl, treated):
+    # sorted merge-join of two profiles on (Chromosome, Coordinate), coordinates are sorted within each chromosome of an mprofile.
+    # returns the chromosome ranges of the joined rows, as [name, first, last] in control order, and the matched control and treated row numbers.
+    ctrl_rows = array("q")
+    treat_rows = array("q")
+    chromosomes = list()
+    ctrl_coords = ctrl.columns["Coordinate"]
+    treat_coords = treated.columns["Coordinate"]
+    for name, i, ctrl_last in ctrl.chromosomes:
+        j, treat_last = treated.region(name)
+        first = len(ctrl_rows)
+        while i < ctrl_last and j < treat_last:
+            if ctrl_coords[i] == treat_coords[j]:
+                ctrl_rows.append(i)
+                treat_rows.append(j)
+                i += 1
+                j += 1
+            elif ctrl_coords[i] < treat_coords[j]:
+                i += 1
+            else:
+                j += 1
+        chromosomes.append([name, first, len(ctrl_rows)])
+    return(chromosomes, ctrl_rows, treat_rows)
+def profile_diff(ctrl, treated, cutoff="NA"):
+    # mutDIFF for whole profiles at once: positions are paired by chromosome and coordinate rather than by line number, and every rate column is subtracted in one pass.
+    # yields the mprofile lines of the treated-control differential; positions found in only one of the profiles are left out.
+    chromosomes, ctrl_rows, treat_rows = join_rows(ctrl, treated)
+    readcounts = list(map(min, map(ctrl.columns["Readcount"].__getitem__, ctrl_rows), map(treated.columns["Readcount"].__getitem__, treat_rows)))
+    rates = [list(map(subtract, map(treated.columns[column].__getitem__, treat_rows), map(ctrl.columns[column].__getitem__, ctrl_rows))) for column in rate_columns]
+    coordinates = ctrl.columns["Coordinate"]
+    bases = ctrl.columns["Ref.Base"]
+    for name, first, last in chromosomes:
+        for row in range(first, last):
+            i = ctrl_rows[row]
+            indels = indel_diff(ctrl.indels(i), treated.indels(treat_rows[row]), cutoff=cutoff)
+            yield(format_row([name, str(coordinates[i]), chr(bases[i]), readcounts[row], [column[row] for column in rates], indels]))
+def bam_mpileup(bam, regions, reference, min_bq=13, max_depth=0):
+    # pile up each region straight from an indexed BAM/CRAM and yield lines in the same format as samtools mpileup -aa, so no mpileup file is ever written.
+    # the read bases are built by pysam/htslib in the same way as samtools (matches as . and , mismatches as bases, deletions as * and indels as +2AG/-1T).
+    # quality and mapping quality columns are left out, as they are not used by de_indel.
+    import pysam as ps
+    if max_depth <= 0:
+        max_depth = 2147483647
+    fasta = ps.FastaFile(reference)
+    with ps.AlignmentFile(bam, reference_filename=reference) as seqfil:
+        for chr, start, end in regions:
+            if end is None:
+                end = seqfil.get_reference_length(chr)
+            ref_bases = fasta.fetch(chr, start, end).upper()
+            # positions without any reads are not returned by pysam, but -aa reports them with a readcount of 0.
+            position = start
+            for column in seqfil.pileup(chr, start, end, truncate=True, stepper="samtools", fastafile=fasta, min_base_quality=min_bq, max_depth=max_depth):
+                for empty in range(position, column.reference_pos):
+                    yield("\t".join([chr, str(empty+1), ref_bases[empty-start:empty-start+1] or "N", "0", "", ""])+"\n")
+                reads = column.get_query_sequences(mark_matches=True, mark_ends=False, add_indels=True)
+                yield("\t".join([chr, str(column.reference_pos+1), ref_bases[column.reference_pos-start:column.reference_pos-start+1] or "N", str(len(reads)), "".join(reads), ""])+"\n")
+                position = column.reference_pos+1
+            for empty in range(position, end):
+                yield("\t".join([chr, str(empty+1), ref_bases[empty-start:empty-start+1] or "N", "0", "", ""])+"\n")
+def read_mpileup(mpileup, args):
+    # yields the lines of an mpileup file, or of the pileup of a BAM/CRAM file when --bam is set.
+    # with --region/--bed only the lines of those regions are read, see regions.region_lines.
+    if args.bam == True:
+        for mpileup_base in bam_mpileup(mpileup, args.regions, args.reference, min_bq=args.min_bq, max_depth=args.max_depth):
+            yield(mpileup_base)
+    elif args.regions is not None:
+        for mpileup_base in region_lines(mpileup, args.regions):
+            yield(mpileup_base)
+    else:
+        with open_input(mpileup) as mpileup_file:
+            for mpileup_base in mpileup_file:
+                yield(mpileup_base)
+def length_classes(args):
+    # the small, mid (lower and upper) and large indel length classifications as ints.
+    return([int(args.small), int(args.mid.split(",")[0]), int(args.mid.split(",")[1]), int(args.large)])
+def write_mprofile(mpileup_file, outputfile, argues, threads=1):
+    # converts mpileup lines into mprofile lines written to outputfile, argues are the cutoff and length classes passed to de_indel.
+    if threads > 1:
+        # batches are converted in parallel and written back in their original order, so the output is identical to a single process run.
+        p=Pool(threads)
+        batches = ([batch]+argues for batch in batch_lines(mpileup_file))
+        for mprofile_block in ordered_map(p, de_indel_batch, batches, threads*2):
+            outputfile.write(mprofile_block)
+        p.close()
+        p.join()
+    else:
+        for mpileup_base in mpileup_file:
+            outputfile.write(de_indel([mpileup_base]+argues))
+def mpileup_profile(mpileup_file, argues, threads=1):
+    # converts mpileup lines straight into a MemoryProfile, the rates and indels are appended as numbers without being formatted as mprofile text and parsed back.
+    profile = MemoryProfile()
+    if threads > 1:
+        p=Pool(threads)
+        batches = ([batch]+argues for batch in batch_lines(mpileup_file))
+        for rows in ordered_map(p, mutation_rates_batch, batches, threads*2):
+            for row in rows:
+                profile.append_row(row)
+        p.close()
+        p.join()
+    else:
+        for mpileup_base in mpileup_file:
+            profile.append_row(mutation_rates([mpileup_base]+argues))
+    return(profile)
+def read_batch(batch):
+    # returns a list of (treated, output) from a batch file, blank lines and lines starting with # are skipped.
+    samples = list()
+    with open(batch) as batchfile:
+        for sample in batchfile:
+            if sample.strip() == "" or sample.startswith("#"):
+                continue
+            columns = sample.rstrip("\r\n").split("\t")
+            if len(columns) < 2:
+                print("\ncallMUT ERROR: Each line of --batch (-bt) needs a treated file and an output file separated by a tab:\n"+sample)
+                sys.exit()
+            samples.append((columns[0], columns[1]))
+    return(samples)
+def batch_sample(argues):
+    # calculates the differential of one treated sample of a batch against the shared control, which is memory-mapped from a binary mprofile so every worker reads the same pages.
+    treated = argues[0]
+    output = argues[1]
+    control = argues[2]
+    args = argues[3]
+    with BinaryProfile(control) as ctrl_profile:
+        if args.preproc == True:
+            treat_profile = load_profile(treated, regions=args.regions)
         else:
-            new_indel = indel.strip(",")
-        if new_indel != "\n":
-            if str(cutoff).upper() != "NA":
-                if float(new_indel.split(":")[1]) > float(cutoff):
-                    formatted_indels = formatted_indels+new_indel+","
-            elif str(cutoff).upper() == "NA":
-                formatted_indels = formatted_indels+new_indel+","
-
-    newctrlindels = {k:v for k,v in ctrl_indels.items() if k not in treatkeys}
-    for indelkey,indelrate in newctrlindels.items():
-        rate = 0 - float(indelrate)
-        new_indel = indelkey+":"+str(rate)
-        if str(cutoff).upper() != "NA":
-            if rate > float(cutoff):
-                formatted_indels = formatted_indels+new_indel+","
-        elif str(cutoff).upper() == "NA":
-            formatted_indels = formatted_indels+new_indel+","
-
-    # return a string of the mutation rates that is ready for writing to an output file.
-    return(('\t'.join([ctrl_columns[0], ctrl_columns[1], ctrl_columns[2], str(readcount), str(a_rate), str(t_rate), str(g_rate), str(c_rate), str(transitions), str(transversions), str(snv_rate), str(in_rate), str(del_rate), str(sml_rate), str(mid_rate), str(lrg_rate), formatted_indels]))+"\n")
+            treat_profile = mpileup_profile(read_mpileup(treated, args), ["NA"]+length_classes(args))
+        if output.endswith(".mprofb"):
+            outputfile = BinaryWriter(output)
+        else:
+            outputfile = open_output(output)
+        rows = 0
+        with treat_profile, outputfile:
+            outputfile.write(mprofile_header)
+            for line in profile_diff(ctrl_profile, treat_profile, cutoff=args.indelcut):
+                outputfile.write(line)
+                rows += 1
+        return([treated, output, len(ctrl_profile)-rows, len(treat_profile)-rows])
+def run_batch(args):
+    # the control is processed once, into a binary mprofile unless it already is one, and each treated sample is then compared to it in a separate process.
+    samples = read_batch(args.batch)
+    temp_control = None
+    # a binary control restricted to --region/--bed is copied into a smaller temporary one, so the regions left out are not reported as missing.
+    if is_binary(args.control) and args.regions is None:
+        control = args.control
+    else:
+        if args.quiet is not None:
+            print("\nProcessing control...\n")
+        if args.preproc == True or is_binary(args.control):
+            ctrl_profile = load_profile(args.control, regions=args.regions)
+        else:
+            ctrl_profile = mpileup_profile(read_mpileup(args.control, args), ["NA"]+length_classes(args), threads=args.threads)
+        handle, temp_control = mkstemp(suffix=".mprofb")
+        os.close(handle)
+        ctrl_profile.save(temp_control)
+        control = temp_control
+        del ctrl_profile
+    try:
+        if args.quiet is not None:
+            print("\nCalculating input-control differential of "+str(len(samples))+" samples...\n")
+        p=Pool(args.threads)
+        for treated, output, ctrl_missing, treat_missing in p.imap_unordered(batch_sample, [[treated, output, control, args] for treated, output in samples]):
+            if args.quiet is not None:
+                print(treated+" -> "+output)
+            if ctrl_missing != 0 or treat_missing != 0:
+                print("\ncallMUT WARNING: "+str(ctrl_missing)+" control and "+str(treat_missing)+" positions of "+treated+" are not in the other mprofile and were left out of the differential.\n")
+        p.close()
+        p.join()
+    finally:
+        if temp_control is not None:
+            os.remove(temp_control)
 def main(args=argypargy()):
-    with open(args.output, 'w') as outputfile:
-        outputfile.write("Chromosome\tCoordinate\tRef.Base\tReadcount\tA.Mutations\tT.Mutations\tG.Mutations\tC.Mutations\tTransitions\tTransversions\tTotal.SNVs\tInsertions\tDeletions\tSmall.Indels\tMid.Indels\tLarge.Indels\tCommon.Indels\n")
+    if args.batch is not None:
+        run_batch(args)
+        return
+    # messages go to stderr when the mprofile itself is written to stdout.
+    messages = sys.stderr if args.output == "-" else sys.stdout
+    if args.convert == True:
+        if args.quiet is not None:
+            print("\nConverting mprofile...\n", file=messages)
+        if args.output.endswith(".mprofb"):
+            mprofile_to_binary(args.input, args.output, regions=args.regions)
+        else:
+            binary_to_mprofile(args.input, args.output, regions=args.regions)
+        return
+    if args.output.endswith(".mprofb"):
+        outputfile = BinaryWriter(args.output)
+    else:
+        outputfile = open_output(args.output)
+    with outputfile:
+        outputfile.write(mprofile_header)
         if args.preproc == False:
-            sml_length = int(args.small)
-            mid_length1 = int(args.mid.split(",")[0])
-            mid_length2 = int(args.mid.split(",")[1])
-            lrg_length = int(args.large)
+            lengths = length_classes(args)
             if args.control is None:
                 if args.quiet is not None:
-                    print("\nProcessing mpileup into mprofile...\n")
-                with open(args.input) as mpileup_file:
-                    for mpileup_base in mpileup_file:
-                        outputfile.write(de_indel([mpileup_base, args.indelcut, sml_length, mid_length1, mid_length2, lrg_length]))
+                    print("\nProcessing mpileup into mprofile...\n", file=messages)
+                write_mprofile(read_mpileup(args.input, args), outputfile, [args.indelcut]+lengths, threads=args.threads)
             elif args.control is not None:
                 if args.quiet is not None:
-                    print("\nProcessing mpileups into mprofiles and calculating input-control differential...\n")
-                with open(args.control) as ctrl_mpileup, open(args.input) as treat_mpileup:
-                    p=Pool(2)
-                    for ctrl, treated in zip(ctrl_mpileup, treat_mpileup):
-                        both_lines=p.map(de_indel, [[ctrl, "NA", sml_length, mid_length1, mid_length2, lrg_length], [treated, "NA", sml_length, mid_length1, mid_length2, lrg_length]])
-                        outputfile.write(mutDIFF(both_lines[0], both_lines[1], cutoff=args.indelcut))
-                    p.close()
+                    print("\nProcessing mpileups into mprofiles and calculating input-control differential...\n", file=messages)
+                ctrl_mpileup = read_mpileup(args.control, args)
+                treat_mpileup = read_mpileup(args.input, args)
+                # each task is a batch of paired control and treated lines, both are converted and their differential taken in the same worker.
+                # runs at least two processes, as was always the case when a control is given.
+                p=Pool(max(2, args.threads))
+                batches = ([batch, args.indelcut]+lengths for batch in batch_lines(zip(ctrl_mpileup, treat_mpileup), size=pair_size))
+                for mprofile_block in ordered_map(p, diff_batch, batches, max(2, args.threads)*2):
+                    outputfile.write(mprofile_block)
+                p.close()
+                p.join()
         elif args.preproc == True:
             if args.quiet is not None:
-                print("\nCalculating input-control differential...\n")
-            with open(args.control) as ctrl_mprofile, open(args.input) as treat_mprofile:
-                next(ctrl_mprofile)
-                next(treat_mprofile)
-                for ctrl, treated in zip(ctrl_mprofile, treat_mprofile):
-                    outputfile.write(mutDIFF(ctrl, treated, cutoff=args.indelcut))
+                print("\nCalculating input-control differential...\n", file=messages)
+            with load_profile(args.control, regions=args.regions) as ctrl_profile, load_profile(args.input, regions=args.regions) as treat_profile:
+                rows = 0
+                for line in profile_diff(ctrl_profile, treat_profile, cutoff=args.indelcut):
+                    outputfile.write(line)
+                    rows += 1
+                if rows != len(ctrl_profile) or rows != len(treat_profile):
+                    print("\ncallMUT WARNING: "+str(len(ctrl_profile)-rows)+" control and "+str(len(treat_profile)-rows)+" treated positions are not in the other mprofile and were left out of the differential.\n", file=messages)
 
@@ -0,0 +1,179 @@
+# Shared file handling for the mProfile tools.
+# Inputs and outputs can be plain text, gzip/bgzip compressed (detected from the file itself for inputs, from a .gz extension for outputs) or '-' for stdin/stdout.
+# Compression and decompression run in a background thread (zlib releases the GIL), so they overlap with the parsing instead of adding to it.
+import sys
+import io
+import gzip
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+
+class BackgroundReader(io.RawIOBase):
+    # reads a binary stream in a separate thread and hands over large blocks through a bounded queue, so memory use stays at blocks*block_size.
+    # source is the file underneath stream (e.g. the compressed file), closed along with it.
+    def __init__(self, stream, block_size=1048576, blocks=8, source=None):
+        self.source = source
+        self.blocks = queue.Queue(blocks)
+        self.block = b""
+        self.offset = 0
+        self.finished = False
+        self.thread = threading.Thread(target=self.fill, args=(stream, block_size))
+        self.thread.daemon = True
+        self.thread.start()
+    def fill(self, stream, block_size):
+        try:
+            block = stream.read(block_size)
+            while block:
+                self.blocks.put(block)
+                block = stream.read(block_size)
+            self.blocks.put(b"")
+        except Exception as e:
+            self.blocks.put(e)
+        finally:
+            stream.close()
+            if self.source is not None:
+                self.source.close()
+    def readable(self):
+        return(True)
+    def readinto(self, b):
+        if self.offset >= len(self.block):
+            if self.finished:
+                return(0)
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.finished = True
+                return(0)
+            self.block = block
+            self.offset = 0
+        n = min(len(b), len(self.block)-self.offset)
+        b[:n] = self.block[self.offset:self.offset+n]
+        self.offset += n
+        return(n)
+class BackgroundWriter(io.RawIOBase):
+    # hands blocks of output to a separate thread that writes (and compresses) them, the queue is bounded so a slow disk cannot fill the memory.
+    def __init__(self, stream, blocks=8):
+        self.stream = stream
+        self.blocks = queue.Queue(blocks)
+        self.error = None
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+    def drain(self):
+        block = self.blocks.get()
+        while block is not None:
+            if self.error is None:
+                try:
+                    self.stream.write(block)
+                except Exception as e:
+                    self.error = e
+            block = self.blocks.get()
+    def writable(self):
+        return(True)
+    def write(self, b):
+        if self.error is not None:
+            raise self.error
+        self.blocks.put(bytes(b))
+        return(len(b))
+    def close(self):
+        if not self.closed:
+            self.blocks.put(None)
+            self.thread.join()
+            self.stream.close()
+            super(BackgroundWriter, self).close()
+            if self.error is not None:
+                raise self.error
+def is_gzip(stream):
+    # gzip and bgzip files both start with the gzip magic number.
+    return(stream.peek(2)[:2] == b"\x1f\x8b")
+def open_binary(path, block_size=1048576):
+    # opens a file for reading as bytes, '-' is stdin, compressed files are decompressed in a background thread.
+    if path == "-":
+        raw = io.BufferedReader(io.FileIO(sys.stdin.fileno(), "rb", closefd=False), block_size)
+    else:
+        raw = open(path, "rb", block_size)
+    if is_gzip(raw):
+        raw = io.BufferedReader(BackgroundReader(gzip.GzipFile(fileobj=raw), block_size, source=raw), block_size)
+    return(raw)
+def open_input(path, block_size=1048576):
+    # opens a text file for reading, '-' is stdin, compressed files are decompressed in a background thread.
+    return(io.TextIOWrapper(open_binary(path, block_size)))
+def open_output(path, block_size=1048576, threaded=False):
+    # opens a text file for writing, '-' is stdout, a .gz extension writes gzip compressed output from a background thread.
+    # threaded also writes uncompressed files from a background thread, for outputs written alongside other work such as the TransloCapture read outputs.
+    if path == "-":
+        sys.stdout.flush()
+        raw = io.FileIO(sys.stdout.fileno(), "wb", closefd=False)
+    elif path.endswith(".gz"):
+        raw = BackgroundWriter(gzip.GzipFile(path, "wb", compresslevel=6))
+    elif threaded:
+        raw = BackgroundWriter(io.FileIO(path, "wb"))
+    else:
+        raw = io.FileIO(path, "wb")
+    return(io.TextIOWrapper(io.BufferedWriter(raw, block_size)))
+class FastqReader(object):
+    # reads a fastq file (plain, gzip/bgzip or '-' for stdin) in large blocks and hands them out as text holding only whole records.
+    # records are found by counting newlines in C (bytes.count/rfind) rather than reading line by line, and line endings are translated as in text mode.
+    def __init__(self, path, block_size=1048576):
+        self.file = open_binary(path, block_size)
+        self.block_size = block_size
+        self.buffer = b""
+        self.held = b""
+        self.lines = 0
+        self.finished = False
+    def __enter__(self):
+        return(self)
+    def __exit__(self, *exc):
+        self.close()
+    def close(self):
+        self.file.close()
+    def fill(self):
+        # adds the next block to the buffer, a trailing carriage return is held back in case its newline is in the next block.
+        data = self.file.read(self.block_size)
+        if not data:
+            self.finished = True
+        block = self.held + data
+        self.held = b""
+        if b"\r" in block:
+            if block.endswith(b"\r") and data:
+                block, self.held = block[:-1], b"\r"
+            block = block.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        self.lines += block.count(b"\n")
+        self.buffer += block
+    def chunk(self, reads=None, most=None):
+        # returns (text, records) of the next whole records: exactly 'reads' records (fewer at the end of the file), or as many as the next block holds (but no more than 'most') if reads is None.
+        # the last record does not need a final newline.
+        while not self.finished and (self.lines < 4*(reads or 1)):
+            self.fill()
+        if self.finished and self.buffer and not self.buffer.endswith(b"\n"):
+            self.buffer += b"\n"
+            self.lines += 1
+        records = self.lines//4
+        if reads is not None:
+            records = min(reads, records)
+        elif most is not None:
+            records = min(most, records)
+        # the end of the last whole record is found by stepping over the lines before it or back over the lines after it, whichever are fewer.
+        if 4*records <= self.lines//2:
+            end = -1
+            for line in range(4*records):
+                end = self.buffer.find(b"\n", end+1)
+        else:
+            end = len(self.buffer)
+            for line in range(self.lines - 4*records + 1):
+                end = self.buffer.rfind(b"\n", 0, end)
+        text = self.buffer[:end+1]
+        self.buffer = self.buffer[end+1:]
+        self.lines -= 4*records
+        return(text.decode(), records)
+    def chunks(self, reads=None):
+        # yields the text of each chunk of whole records until the end of the file.
+        text, records = self.chunk(reads)
+        while records:
+            yield(text)
+            text, records = self.chunk(reads)
@@ -0,0 +1,110 @@
+# Fragment size distributions for StructureMap, counted into fixed-size histograms rather than written out one size per read.
+# Sizes up to max_size have a bin each. Larger sizes go into overflow bins by their number of bits, i.e. max_size+1 to 2^n-1, 2^n to 2^(n+1)-1 and so on, so any size is counted in the same fixed array.
+from array import array
+
+
+
+mad_scale = 1.4826 # MAD to standard deviation, for normally distributed sizes
+summary_percentiles = [1, 5, 25, 75, 95, 99]
+
+class SizeHistogram(object):
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.counts = array("q", bytes(8*(max_size+65)))
+    def index(self, size):
+        if size <= self.max_size:
+            return(size)
+        return(self.max_size+size.bit_length())
+    def add(self, size, count=1):
+        self.counts[self.index(size)] += count
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            if count:
+                self.counts[i] += count
+    def total(self):
+        return(sum(self.counts))
+    def span(self, i):
+        # the (smallest, largest) size of bin i.
+        if i <= self.max_size:
+            return((i, i))
+        bits = i-self.max_size
+        return(max(self.max_size+1, 1 << (bits-1)), (1 << bits)-1)
+    def bins(self):
+        # yields (smallest, largest, count) of each bin holding any sizes, in order of size.
+        for i, count in enumerate(self.counts):
+            if count:
+                low, high = self.span(i)
+                yield((low, high, count))
+    def quantile(self, q):
+        # the size below which a fraction q of the sizes fall, the smallest size of its bin if it is an overflow bin.
+        total = self.total()
+        if total == 0:
+            return(0)
+        target = q*total
+        seen = 0
+        for low, high, count in self.bins():
+            seen += count
+            if seen >= target:
+                return(low)
+        return(low)
+    def mad(self, median=None):
+        # the median absolute deviation from the median, from the distance of each bin to the median.
+        if median is None:
+            median = self.quantile(0.5)
+        deviations = SizeHistogram(self.max_size)
+        for low, high, count in self.bins():
+            deviations.add(abs(low-median), count)
+        return(deviations.quantile(0.5))
+    def mean(self):
+        total = self.total()
+        if total == 0:
+            return(0)
+        return(sum([low*count for low, high, count in self.bins()])/total)
+    def insert_max(self, deviations=10):
+        # a data-driven --insert_max, the median plus a number of standard deviations (estimated from the MAD) of the fragment sizes.
+        median = self.quantile(0.5)
+        return(int(median+deviations*mad_scale*self.mad(median)+0.5))
+    def summary(self):
+        # the summary statistics as (name, value) pairs.
+        median = self.quantile(0.5)
+        stats = [("pairs", self.total()), ("mean", round(self.mean(), 2)), ("median", median), ("MAD", self.mad(median))]
+        stats += [("P"+str(percentile), self.quantile(percentile/100)) for percentile in summary_percentiles]
+        stats.append(("overflow", sum(self.counts[self.max_size+1:])))
+        stats.append(("insert_max", self.insert_max()))
+        return(stats)
+class FragmentSizes(object):
+    # the fragment sizes of a run, one histogram for all contigs or, with per_contig, one for each contig that are added together for the summary.
+    def __init__(self, contigs, per_contig=False, max_size=10000):
+        self.contigs = contigs
+        self.per_contig = per_contig
+        self.max_size = max_size
+        self.histograms = {}
+    def counts(self, ref):
+        # the count array that sizes of contig ref (a reference id) are added to.
+        key = ref if self.per_contig else None
+        if key not in self.histograms:
+            self.histograms[key] = SizeHistogram(self.max_size)
+        return(self.histograms[key].counts)
+    def merge(self, other):
+        for key, histogram in other.histograms.items():
+            if key not in self.histograms:
+                self.histograms[key] = SizeHistogram(self.max_size)
+            self.histograms[key].merge(histogram)
+    def combined(self):
+        histogram = SizeHistogram(self.max_size)
+        for contig_histogram in self.histograms.values():
+            histogram.merge(contig_histogram)
+        return(histogram)
+    def write(self, path):
+        # the summary statistics as "#name=value" lines, then the count of each size (Size, Count and, per contig, a count column for each contig).
+        histogram = self.combined()
+        contig_keys = sorted([key for key in self.histograms if key is not None])
+        with open(path, "w") as table:
+            for name, value in histogram.summary():
+                table.write("#"+name+"="+str(value)+"\n")
+            table.write("\t".join(["Size", "Count"]+[self.contigs[key] for key in contig_keys])+"\n")
+            for i, count in enumerate(histogram.counts):
+                if count:
+                    low, high = histogram.span(i)
+                    size = str(low) if low == high else str(low)+"-"+str(high)
+                    table.write("\t".join([size, str(count)]+[str(self.histograms[key].counts[i]) for key in contig_keys])+"\n")
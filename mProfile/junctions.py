@@ -0,0 +1,59 @@
+# Junction catalogue for TransloCapture, the sequences between the donor and acceptor primers of crossover reads counted for each donor-acceptor pair.
+# Every unique sequencing error gives a new junction, so each pair's junctions are counted in a JunctionCounter that keeps only the most frequent ones and memory stays bounded however many reads there are.
+
+
+
+class JunctionCounter(object):
+    # a Space-Saving style heavy-hitter counter holding at most 2*capacity sequences.
+    # once full, the sequences are cut back to the capacity most frequent and the highest count dropped becomes the floor. A new sequence starts from the floor, as it may have been one of those dropped, so counts are over-estimates by at most their error and any sequence seen more than floor times is still held.
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+    def add(self, sequence, count=1):
+        counts = self.counts
+        if sequence in counts:
+            counts[sequence] += count
+        else:
+            counts[sequence] = self.floor+count
+            if self.floor:
+                self.errors[sequence] = self.floor
+            if len(counts) >= 2*self.capacity:
+                self.prune()
+    def prune(self):
+        ranked = self.top()
+        self.floor = max(self.floor, ranked[self.capacity][1])
+        self.counts = dict((sequence, count) for sequence, count, error in ranked[:self.capacity])
+        self.errors = dict((sequence, error) for sequence, count, error in ranked[:self.capacity] if error)
+    def top(self, n=None):
+        # the n most frequent sequences as (sequence, count, error), ties by sequence so the order does not depend on the input order.
+        ranked = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        if n is not None:
+            ranked = ranked[:n]
+        return([(sequence, count, self.errors.get(sequence, 0)) for sequence, count in ranked])
+class JunctionCatalogue(object):
+    # a JunctionCounter for each donor-acceptor crossover, named as in TransloCapture's crossover counts.
+    def __init__(self, top=10):
+        self.top = top
+        self.capacity = max(1000, 100*top)
+        self.events = {}
+    def merge(self, partial):
+        # adds the exact {event: {junction: reads}} counts of a chunk of reads.
+        for event, junctions in partial.items():
+            if event not in self.events:
+                self.events[event] = JunctionCounter(self.capacity)
+            counter = self.events[event]
+            for sequence, count in junctions.items():
+                counter.add(sequence, count)
+    def write(self, path, primer_names):
+        # the top junctions of each crossover, with their reads and the most the read count could be over-estimated by (0 unless that pair had more unique junctions than its counter holds).
+        # Length is NA for PE junctions whose mates did not overlap.
+        with open(path, "w") as table:
+            table.write("Donor,Acceptor,Rank,Junction,Length,Reads,Max.Overcount\n")
+            for donor in primer_names:
+                for acceptor in primer_names:
+                    event = donor+"-"+acceptor
+                    if event in self.events:
+                        for rank, (sequence, count, error) in enumerate(self.events[event].top(self.top)):
+                            table.write(",".join([donor, acceptor, str(rank+1), sequence, "NA" if "..." in sequence else str(len(sequence)), str(count), str(error)])+"\n")
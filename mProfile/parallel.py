@@ -0,0 +1,28 @@
+# Helpers shared by the mProfile tools for splitting their input into batches that are processed by a pool of worker processes.
+from collections import deque
+
+
+
+def batch_lines(lines, max_bytes=4000000, max_lines=1000, size=len):
+    # group lines into batches that are limited by size as well as number, as a single deep position can be several MB of read bases.
+    batch = list()
+    batch_bytes = 0
+    for line in lines:
+        batch.append(line)
+        batch_bytes += size(line)
+        if batch_bytes >= max_bytes or len(batch) >= max_lines:
+            yield batch
+            batch = list()
+            batch_bytes = 0
+    if batch:
+        yield batch
+def ordered_map(p, func, tasks, ahead):
+    # like Pool.imap, results come back in the order the tasks were given, but only 'ahead' tasks are in flight at once.
+    # this stops the whole input file being read into memory when the workers are slower than the reader.
+    pending = deque()
+    for task in tasks:
+        pending.append(p.apply_async(func, (task,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
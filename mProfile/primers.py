@@ -0,0 +1,239 @@
+# Primer matching for TransloCapture.
+# Every primer is indexed once by its first k bases, so finding which primers start a read is a few dict lookups at the start of the read rather than a substring search per primer.
+# A primer only counts if it lies within its window (primer length + sensitivity) from the end of the read it is searched at, as in the original per-primer checks.
+# With mismatches > 0 the primers are instead matched allowing that many substituted bases, see MismatchIndex, and reads are assigned to the primers that match them best, see PrimerPanel.best.
+from operator import ne
+
+
+
+def rev_comp(seq):
+    newseq = seq.replace("A", "t")
+    newseq = newseq.replace("T", "a")
+    newseq = newseq.replace("G", "c")
+    newseq = newseq.replace("C", "g")
+    return(newseq.upper()[::-1])
+def read_primers(site_file, sens):
+    # returns the names, forward and reverse primers (first base removed) and their windows (full primer length + sens) from the primer csv.
+    primer_names = list()
+    fw_primer_list = list()
+    rv_primer_list = list()
+    fw_lens = list()
+    rv_lens = list()
+    with open(site_file) as sites:
+        for site in sites:
+            columns = site.split(",")
+            primer_names.append(columns[0])
+            fw_primer_list.append(columns[1].upper()[1:])
+            rv_primer_list.append(columns[2].replace("\n", "").replace("\r", "").upper()[1:])
+            fw_lens.append(len(columns[1])+sens)
+            rv_lens.append(len(columns[2].replace("\n", "").replace("\r", ""))+sens)
+    return(primer_names, fw_primer_list, rv_primer_list, fw_lens, rv_lens)
+class PrimerIndex(object):
+    # finds which of a set of sequences occur in read[:window], each sequence having its own window.
+    # sequences are looked up by their first k bases, and only at the offsets where a sequence could still end inside its window, so the cost depends on the sensitivity and not on the number of primers.
+    def __init__(self, patterns):
+        # patterns is a list of (key, sequence, window).
+        lengths = [len(sequence) for key, sequence, window in patterns if sequence != ""]
+        self.k = min(min(lengths) if lengths else 1, 12)
+        self.kmers = {}
+        self.short = list()
+        self.last = -1
+        for key, sequence, window in patterns:
+            if len(sequence) < self.k:
+                self.short.append((key, sequence, window))
+            else:
+                self.kmers.setdefault(sequence[:self.k], list()).append((key, sequence, window))
+                self.last = max(self.last, window-len(sequence))
+    def find(self, read):
+        # returns {key: (offset, mismatches)} of the sequences found in the read within their window, the offset is the leftmost match and mismatches always 0.
+        found = {}
+        k = self.k
+        kmers = self.kmers
+        for i in range(min(self.last, len(read)-k)+1):
+            matches = kmers.get(read[i:i+k])
+            if matches is not None:
+                for key, sequence, window in matches:
+                    if key not in found and i+len(sequence) <= window and read.startswith(sequence, i):
+                        found[key] = (i, 0)
+        for key, sequence, window in self.short:
+            if key not in found:
+                i = read[:window].find(sequence)
+                if i != -1:
+                    found[key] = (i, 0)
+        return(found)
+class MismatchIndex(object):
+    # finds which of a set of sequences occur in read[:window] with up to k mismatches, with the same find() as PrimerIndex.
+    # each sequence is cut into k+1 pieces and at least one of them must match exactly if there are k mismatches or fewer, so the pieces are looked up like the k-mers of PrimerIndex and only the sequences they point to are compared base by base.
+    def __init__(self, patterns, mismatches):
+        self.mismatches = mismatches
+        lengths = [len(sequence)//(mismatches+1) for key, sequence, window in patterns if len(sequence) > mismatches]
+        self.k = min(min(lengths) if lengths else 1, 12)
+        self.kmers = {}
+        self.short = list()
+        self.last = -1
+        for key, sequence, window in patterns:
+            piece = len(sequence)//(mismatches+1)
+            if piece < self.k:
+                self.short.append((key, sequence, window))
+            else:
+                for offset in range(0, piece*(mismatches+1), piece):
+                    self.kmers.setdefault(sequence[offset:offset+self.k], list()).append((key, sequence, window, offset))
+                    self.last = max(self.last, window-len(sequence)+offset)
+    def find(self, read):
+        # returns {key: (offset, mismatches)} of the sequences found in the read within their window, the match with the fewest mismatches and of those the leftmost.
+        found = {}
+        k = self.k
+        kmers = self.kmers
+        mismatches = self.mismatches
+        for i in range(min(self.last, len(read)-k)+1):
+            matches = kmers.get(read[i:i+k])
+            if matches is not None:
+                for key, sequence, window, offset in matches:
+                    start = i-offset
+                    end = start+len(sequence)
+                    if start >= 0 and end <= window and end <= len(read):
+                        count = sum(map(ne, sequence, read[start:end]))
+                        if count <= mismatches and (key not in found or (count, start) < found[key][::-1]):
+                            found[key] = (start, count)
+        for key, sequence, window in self.short:
+            text = read[:window]
+            for start in range(len(text)-len(sequence)+1):
+                count = sum(map(ne, sequence, text[start:start+len(sequence)]))
+                if count <= mismatches and (key not in found or count < found[key][1]):
+                    found[key] = (start, count)
+        return(found)
+def mate_shift(insert1, insert2, overlap=12, mismatch_rate=0.1):
+    # the position of insert2 in insert1 (negative if it starts before insert1) where the two overlap by at least 'overlap' bases with no more than mismatch_rate of the overlapping bases mismatched, or None. Of several, the longest overlap is taken.
+    # overlaps at or after the start of insert1 begin at the start of insert2 and those before it at the start of insert1, so pieces of overlap//2 bases are cut from the start of each. An overlap with fewer mismatches than it holds whole pieces has at least one piece matching exactly, which gives the shifts to check.
+    k = max(1, overlap//2)
+    shifts = set()
+    for seq, other, sign in ((insert2, insert1, 1), (insert1, insert2, -1)):
+        for offset in range(0, len(seq)-k+1, k):
+            found = other.find(seq[offset:offset+k])
+            while found != -1:
+                shifts.add(sign*(found-offset))
+                found = other.find(seq[offset:offset+k], found+1)
+    best = None
+    for shift in shifts:
+        start1 = max(0, shift)
+        start2 = max(0, -shift)
+        length = min(len(insert1)-start1, len(insert2)-start2)
+        if length < overlap or best is not None and length <= best[0]:
+            continue
+        if sum(map(ne, insert1[start1:start1+length], insert2[start2:start2+length])) <= length*mismatch_rate:
+            best = (length, shift)
+    return(None if best is None else best[1])
+class PrimerPanel(object):
+    # the primers of a TransloCapture run, indexed for both ends of the reads.
+    # keys are 2*primer for the forward and 2*primer+1 for the reverse primer. The head is read 1 (or the start of a SR read) and the tail is read 2 (or the end of a SR read, searched as the reversed read for the complemented primers).
+    def __init__(self, site_file, sens, paired=True, mismatches=0):
+        self.names, self.fw_primers, self.rv_primers, self.fw_lens, self.rv_lens = read_primers(site_file, sens)
+        self.paired = paired
+        self.mismatches = mismatches
+        head = list()
+        tail = list()
+        for primer, (fw, rv, fw_l, rv_l) in enumerate(zip(self.fw_primers, self.rv_primers, self.fw_lens, self.rv_lens)):
+            head += [(2*primer, fw, fw_l), (2*primer+1, rv, rv_l)]
+            if paired:
+                tail += [(2*primer, fw, fw_l), (2*primer+1, rv, rv_l)]
+            else:
+                # rev_comp(primer) in read[-window:] is the same as its complement in the reversed read[:window].
+                tail += [(2*primer, rev_comp(fw)[::-1], fw_l), (2*primer+1, rev_comp(rv)[::-1], rv_l)]
+        if mismatches > 0:
+            self.head = MismatchIndex(head, mismatches)
+            self.tail = MismatchIndex(tail, mismatches)
+        else:
+            self.head = PrimerIndex(head)
+            self.tail = PrimerIndex(tail)
+        # after a reverse primer donor, SR reads look for the acceptor's forward primer first and PE reads for its reverse primer, each labelled as in the original read headers.
+        if paired:
+            self.rv_acceptors = [(1, "rv"), (0, "fw")]
+        else:
+            self.rv_acceptors = [(0, "rv"), (1, "fw")]
+    def classify(self, read, read2=None):
+        # returns None if no donor primer is found, (donor, None, end, None) for a canonical amplicon or (donor, acceptor, donor end, acceptor end) for a crossover, primers as indices into names.
+        return(self.match(read, read2)[0])
+    def match(self, read, read2=None):
+        # classify() along with the {key: (offset, mismatches)} primer matches at the head and tail of the read, which junction() uses to cut out the sequence between the primers.
+        head = self.head.find(read)
+        if not head:
+            return(None, head, None)
+        if self.paired:
+            tail = self.tail.find(read2)
+        else:
+            tail = self.tail.find(read[::-1])
+        return(self.assign(head, tail), head, tail)
+    def assign(self, head, tail):
+        # donors are tried in the order of the primer csv, and for each the acceptors in the same order, so the result is the same as searching every primer in turn.
+        # with mismatches, primers that differ by a base or two can all match, so the order of the csv is only used to break ties, see best().
+        if self.mismatches > 0:
+            return(self.best(head, tail))
+        tail_primers = sorted(set([key >> 1 for key in tail]))
+        names = self.names
+        for donor in sorted(set([key >> 1 for key in head])):
+            if 2*donor in head:
+                if 2*donor+1 in tail:
+                    return((donor, None, "fw", None))
+                acceptor_keys = [(1, "rv"), (0, "fw")]
+                donor_end = "fw"
+            else:
+                if 2*donor in tail:
+                    return((donor, None, "rv", None))
+                acceptor_keys = self.rv_acceptors
+                donor_end = "rv"
+            for acceptor in tail_primers:
+                if names[acceptor] != names[donor]:
+                    for kind, acceptor_end in acceptor_keys:
+                        if 2*acceptor+kind in tail:
+                            return((donor, acceptor, donor_end, acceptor_end))
+        return(None)
+    def best(self, head, tail):
+        # the reading of a read with the fewest mismatches over its two primers, a canonical amplicon over a crossover if they are as good, and after that the first in the order of assign().
+        # so a canonical read is not taken for a crossover from a primer that only matches it with mismatches.
+        names = self.names
+        readings = list()
+        for donor_key, (offset, donor_mismatches) in head.items():
+            donor = donor_key >> 1
+            if donor_key & 1:
+                donor_end = "rv"
+                acceptor_keys = self.rv_acceptors
+            else:
+                donor_end = "fw"
+                acceptor_keys = [(1, "rv"), (0, "fw")]
+            canonical_key = donor_key ^ 1
+            if canonical_key in tail:
+                readings.append((donor_mismatches+tail[canonical_key][1], 0, donor, donor_key & 1, 0, 0, (donor, None, donor_end, None)))
+            for tail_key, (offset, acceptor_mismatches) in tail.items():
+                acceptor = tail_key >> 1
+                if names[acceptor] != names[donor]:
+                    for order, (kind, acceptor_end) in enumerate(acceptor_keys):
+                        if tail_key & 1 == kind:
+                            readings.append((donor_mismatches+acceptor_mismatches, 1, donor, donor_key & 1, acceptor, order, (donor, acceptor, donor_end, acceptor_end)))
+        if not readings:
+            return(None)
+        return(min(readings)[-1])
+    def junction(self, found, head, tail, read, read2=None, overlap=12):
+        # the sequence between the donor and acceptor primers of a crossover read, as read from the donor, from the results of match().
+        # PE reads are joined where read 1 overlaps the reverse complement of read 2 by at least 'overlap' bases (allowing sequencing errors, see mate_shift), with read 1's bases kept over the overlap, or where read 1 already holds the acceptor primer. Mates that do not overlap are joined with "..." in place of the unread bases.
+        donor, acceptor, donor_end, acceptor_end = found
+        donor_key = 2*donor+(donor_end == "rv")
+        donor_primer = self.fw_primers[donor] if donor_end == "fw" else self.rv_primers[donor]
+        # the acceptor end labels follow the original read headers, so the primer that was matched is looked up from the label as in assign().
+        acceptor_keys = [(1, "rv"), (0, "fw")] if donor_end == "fw" else self.rv_acceptors
+        kind = [kind for kind, label in acceptor_keys if label == acceptor_end][0]
+        acceptor_key = 2*acceptor+kind
+        acceptor_primer = self.rv_primers[acceptor] if kind else self.fw_primers[acceptor]
+        start = head[donor_key][0]+len(donor_primer)
+        if not self.paired:
+            # the tail was matched in the reversed read, so the acceptor primer starts this far from the end of the read.
+            return(read[start:max(start, len(read)-tail[acceptor_key][0]-len(acceptor_primer))])
+        insert1 = read[start:]
+        end = insert1.find(rev_comp(acceptor_primer))
+        if end != -1:
+            return(insert1[:end])
+        insert2 = rev_comp(read2[tail[acceptor_key][0]+len(acceptor_primer):])
+        shift = mate_shift(insert1, insert2, overlap)
+        if shift is None:
+            return(insert1+"..."+insert2)
+        # the junction ends where insert2 (and the acceptor primer) ends, insert2 only adds the bases past the end of read 1.
+        return(insert1[:shift+len(insert2)]+insert2[len(insert1)-shift:])
@@ -0,0 +1,150 @@
+# Region restriction for mpileups and mprofiles, so a few targets can be read without scanning the whole file.
+# Plain files get a sidecar index (<file>.mpi) mapping blocks of lines to their chromosome, coordinates and byte offset. It is built on the first region run and reused while the file is unchanged.
+# bgzip files with a tabix index (tabix -s1 -b2 -e2) are read through pysam, anything else that cannot be seeked (gzip, stdin) is scanned and filtered.
+import os
+from bisect import bisect_right
+from mProfile.fileio import open_input
+
+
+
+index_version = "#mpi1"
+
+def parse_region(region):
+    # splits chr:start-end (1-based and inclusive, as in samtools) or just chr into a bed style (chromosome, start, end) region, 0-based and end exclusive.
+    name, colon, span = region.rpartition(":")
+    if colon == "" or "-" not in span:
+        return((region, 0, None))
+    start, end = span.replace(",", "").split("-")
+    return((name, int(start)-1, int(end)))
+def read_bed(bed):
+    # returns a list of (chromosome, start, end) for each region in a bed file, coordinates are 0-based and end exclusive as in the bed format.
+    regions = list()
+    with open(bed) as bedfile:
+        for region in bedfile:
+            if region.strip() == "" or region.startswith(("#", "track", "browser")):
+                continue
+            columns = region.split()
+            regions.append((columns[0], int(columns[1]), int(columns[2])))
+    return(regions)
+def merge_regions(regions):
+    # sorts the regions within each chromosome and merges any that overlap, so no position is read twice.
+    # the regions of a chromosome are kept together, so its rows stay contiguous in the mprofile.
+    chromosomes = {}
+    order = list()
+    for name, start, end in regions:
+        if name not in chromosomes:
+            chromosomes[name] = list()
+            order.append(name)
+        chromosomes[name].append((start, end))
+    merged = list()
+    for name in order:
+        spans = sorted(chromosomes[name], key=lambda span: (span[0], float("inf") if span[1] is None else span[1]))
+        current = list(spans[0])
+        for start, end in spans[1:]:
+            if current[1] is None or start <= current[1]:
+                if current[1] is not None and (end is None or end > current[1]):
+                    current[1] = end
+            else:
+                merged.append((name, current[0], current[1]))
+                current = [start, end]
+        merged.append((name, current[0], current[1]))
+    return(merged)
+def build_index(path, block_lines=4096):
+    # one pass over the file recording [chromosome, first coordinate, byte offset] every block_lines lines and whenever the chromosome changes.
+    blocks = list()
+    offset = 0
+    lines = 0
+    name = None
+    with open(path, "rb") as tsv:
+        for line in tsv:
+            if not line.startswith(b"Chromosome\t") and line.strip() != b"":
+                columns = line.split(b"\t", 2)
+                if columns[0] != name or lines >= block_lines:
+                    name = columns[0]
+                    blocks.append([name.decode(), int(columns[1]), offset])
+                    lines = 0
+                lines += 1
+            offset += len(line)
+    return(blocks)
+def load_index(path):
+    # returns {chromosome: ([first coordinates], [byte offsets])}, reading the sidecar index or building and saving it if it is missing or out of date.
+    # the index records the size and modification time of the file it was built from, so a rewritten mpileup is indexed again.
+    stat = os.stat(path)
+    stamp = "\t".join([index_version, str(stat.st_size), str(int(stat.st_mtime))])
+    blocks = None
+    try:
+        with open(path+".mpi") as index:
+            if index.readline().rstrip("\n") == stamp:
+                blocks = [[name, int(coordinate), int(offset)] for name, coordinate, offset in (line.rstrip("\n").split("\t") for line in index)]
+    except IOError:
+        pass
+    if blocks is None:
+        blocks = build_index(path)
+        try:
+            with open(path+".mpi", "w") as index:
+                index.write(stamp+"\n")
+                for block in blocks:
+                    index.write("\t".join([str(field) for field in block])+"\n")
+        except IOError:
+            # a read-only directory only means the index is built again next time.
+            pass
+    chromosomes = {}
+    for name, coordinate, offset in blocks:
+        coordinates, offsets = chromosomes.setdefault(name, (list(), list()))
+        coordinates.append(coordinate)
+        offsets.append(offset)
+    return(chromosomes)
+def seekable(path):
+    if path == "-":
+        return(False)
+    with open(path, "rb") as tsv:
+        return(tsv.read(2) != b"\x1f\x8b")
+def indexed_lines(path, regions):
+    # seeks to the block holding the start of each region and reads lines until the region (or its chromosome) ends.
+    # regions are read in the order of the file's chromosomes, the same order a full scan gives.
+    chromosomes = load_index(path)
+    order = dict((name, i) for i, name in enumerate(chromosomes))
+    regions = sorted([region for region in regions if region[0] in chromosomes], key=lambda region: order[region[0]])
+    with open(path, "rb") as tsv:
+        for name, start, end in regions:
+            coordinates, offsets = chromosomes[name]
+            tsv.seek(offsets[max(0, bisect_right(coordinates, start+1)-1)])
+            chromosome = name.encode()
+            for line in tsv:
+                columns = line.split(b"\t", 2)
+                if columns[0] != chromosome or (end is not None and int(columns[1]) > end):
+                    break
+                if int(columns[1]) > start:
+                    yield(line.decode())
+def tabix_lines(path, regions):
+    import pysam as ps
+    with ps.TabixFile(path) as tabix:
+        order = dict((name, i) for i, name in enumerate(tabix.contigs))
+        for name, start, end in sorted([region for region in regions if region[0] in order], key=lambda region: order[region[0]]):
+            for line in tabix.fetch(name, start, end):
+                yield(line+"\n")
+def filtered_lines(path, regions):
+    # a full scan keeping only the lines inside the regions, for inputs that cannot be seeked.
+    chromosomes = {}
+    for name, start, end in regions:
+        chromosomes.setdefault(name, list()).append((start, end))
+    with open_input(path) as tsv:
+        for line in tsv:
+            columns = line.split("\t", 2)
+            if columns[0] in chromosomes and len(columns) > 2:
+                coordinate = int(columns[1])
+                for start, end in chromosomes[columns[0]]:
+                    if start < coordinate and (end is None or coordinate <= end):
+                        yield(line)
+                        break
+def region_lines(path, regions):
+    # yields the lines of an mpileup or text mprofile (chromosome and coordinate in the first two columns) that fall inside the regions.
+    regions = merge_regions(regions)
+    if seekable(path):
+        lines = indexed_lines(path, regions)
+    elif path != "-" and (os.path.exists(path+".tbi") or os.path.exists(path+".csi")):
+        lines = tabix_lines(path, regions)
+    else:
+        lines = filtered_lines(path, regions)
+    for line in lines:
+        yield(line)
@@ -0,0 +1,154 @@
+# Writing and reading StructureMap structure profiles (.sprofile).
+# Rows are streamed to the output as they are found, so memory does not grow with the number of aberrant pairs. The number of reads is only known at the end, so it is written as a last "#reads=" line rather than in the header.
+# A .gz output is bgzip compressed (so it can be indexed with tabix -0 -s1 -b3 -e3 -S1, the coordinates are 0-based as in pysam), and a .sprofb output is a binary sprofile of fixed-width rows that can be memory-mapped and filtered without parsing text.
+# Binary layout: magic, the rows (each a little-endian struct of row_format), then a JSON footer (contigs, aberrations, rows and reads), its 8 byte length and the magic again.
+import io
+import json
+import mmap
+import struct
+from mProfile.fileio import BackgroundWriter, open_input
+
+
+
+magic = b"SPROFB1\n"
+sprofile_header = "Chr FW\tChr RV\tCoord FW\tCoord RV\tStrand FW\tStrand RV\tInsert bp\tAbberation\tFlag\n"
+aberrations = ["Deletion", "Inter-chromosomal translocation", "Large insert", "Same strand", "Diverging", "Other", "Unknown"]
+aberration_codes = dict((aberration, code) for code, aberration in enumerate(aberrations))
+strand_codes = {"+": 0, "-": 1}
+# chr fw, chr rv (indices into the contigs), coord fw, coord rv, insert, flag, strand fw, strand rv, aberration.
+row_format = "<iiqqqHBBB"
+row_struct = struct.Struct(row_format)
+
+class SprofileRows(object):
+    # the rows of a structure profile, as text or packed binary rows, kept until take() hands them over.
+    # add() takes the row's values unformatted, so they are only formatted for rows that are kept. They are also passed on to events (e.g. an EventClusters) if given.
+    def __init__(self, contigs, binary=False, events=None):
+        self.contigs = contigs
+        self.binary = binary
+        self.events = events
+        self.rows = list()
+    def add(self, ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, insert, aberration, flag):
+        if self.binary:
+            self.rows.append(row_struct.pack(ref_x, ref_y, coord_x, coord_y, insert, flag, strand_codes[strand_x], strand_codes[strand_y], aberration_codes[aberration]))
+        else:
+            self.rows.append("\t".join([self.contigs[ref_x], self.contigs[ref_y], str(coord_x), str(coord_y), strand_x, strand_y, str(insert), aberration, str(flag)])+"\n")
+        if self.events is not None:
+            self.events.add(ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, insert, aberration, flag)
+    def take(self):
+        # returns the rows so far as one block of text or bytes.
+        if self.binary:
+            block = b"".join(self.rows)
+        else:
+            block = "".join(self.rows)
+        self.rows = list()
+        return(block)
+class SprofileWriter(SprofileRows):
+    # streams rows to an sprofile, written every 'buffer' rows by a background thread. Blocks taken from other SprofileRows (e.g. from worker processes) are written with write().
+    # close(reads) ends the file with the read count.
+    def __init__(self, path, contigs, buffer=10000, events=None):
+        SprofileRows.__init__(self, contigs, binary=path.endswith(".sprofb"), events=events)
+        self.path = path
+        self.buffer = buffer
+        self.count = 0
+        if self.binary:
+            self.file = BackgroundWriter(io.FileIO(path, "wb"))
+            self.file.write(magic)
+        else:
+            if path.endswith(".gz"):
+                import pysam as ps
+                raw = BackgroundWriter(ps.BGZFile(path, "wb"))
+            else:
+                raw = BackgroundWriter(io.FileIO(path, "wb"))
+            self.file = io.TextIOWrapper(io.BufferedWriter(raw, 1048576))
+            self.file.write(sprofile_header)
+    def add(self, ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, insert, aberration, flag):
+        SprofileRows.add(self, ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, insert, aberration, flag)
+        if len(self.rows) >= self.buffer:
+            self.write(self.take())
+    def write(self, block):
+        if self.binary:
+            self.count += len(block)//row_struct.size
+        else:
+            self.count += block.count("\n")
+        self.file.write(block)
+    def close(self, reads):
+        self.write(self.take())
+        if self.binary:
+            footer = json.dumps({"rows": self.count, "reads": reads, "contigs": list(self.contigs), "aberrations": aberrations, "row_format": row_format}).encode()
+            self.file.write(footer+len(footer).to_bytes(8, "little")+magic)
+        else:
+            self.file.write("#reads="+str(reads)+"\n")
+        self.file.close()
+def is_binary(path):
+    with open(path, "rb") as sprofile:
+        return(sprofile.read(len(magic)) == magic)
+class BinarySprofile(object):
+    # read-only, memory-mapped access to a .sprofb file. records() filters on the integer columns before anything is unpacked into strings.
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(magic)] != magic or self.map[-len(magic):] != magic:
+            self.close()
+            raise ValueError(path+" is not a complete binary sprofile (.sprofb).")
+        footer_length = int.from_bytes(self.map[-len(magic)-8:-len(magic)], "little")
+        footer = json.loads(self.map[-len(magic)-8-footer_length:-len(magic)-8].decode())
+        self.rows = footer["rows"]
+        self.reads = footer["reads"]
+        self.contigs = footer["contigs"]
+        self.aberrations = footer["aberrations"]
+        self.row_struct = struct.Struct(footer["row_format"])
+    def __enter__(self):
+        return(self)
+    def __exit__(self, *exc):
+        self.close()
+    def __len__(self):
+        return(self.rows)
+    def close(self):
+        self.map.close()
+        self.file.close()
+    def records(self, aberrations=None, chr=None, start=None, end=None):
+        # yields the unpacked rows (chr fw, chr rv, coord fw, coord rv, insert, flag, strand fw, strand rv, aberration as codes), optionally only those of some aberrations or with the forward read in chr:start-end.
+        aberration_filter = None if aberrations is None else set([self.aberrations.index(aberration) for aberration in aberrations])
+        contig = None if chr is None else self.contigs.index(chr)
+        view = memoryview(self.map)[len(magic):len(magic)+self.rows*self.row_struct.size]
+        for record in self.row_struct.iter_unpack(view):
+            if aberration_filter is not None and record[8] not in aberration_filter:
+                continue
+            if contig is not None and (record[0] != contig or start is not None and record[2] < start or end is not None and record[2] >= end):
+                continue
+            yield(record)
+        view.release()
+    def lines(self, aberrations=None, chr=None, start=None, end=None):
+        # the rows as sprofile text lines, filtered as in records().
+        strands = ["+", "-"]
+        for ref_x, ref_y, coord_x, coord_y, insert, flag, strand_x, strand_y, aberration in self.records(aberrations, chr, start, end):
+            yield("\t".join([self.contigs[ref_x], self.contigs[ref_y], str(coord_x), str(coord_y), strands[strand_x], strands[strand_y], str(insert), self.aberrations[aberration], str(flag)])+"\n")
+def sprofile_reads(path):
+    # the read count of an sprofile, from its last line or, for files written before it moved there, from the header.
+    if is_binary(path):
+        with BinarySprofile(path) as sprofile:
+            return(sprofile.reads)
+    reads = None
+    with open(path, "rb") as sprofile:
+        if sprofile.read(2) != b"\x1f\x8b":
+            # plain text, only the end of the file needs reading.
+            sprofile.seek(0, 2)
+            sprofile.seek(max(0, sprofile.tell()-4096))
+            for line in sprofile.read().decode().split("\n"):
+                if line.startswith("#reads="):
+                    reads = int(line[len("#reads="):])
+            if reads is not None:
+                return(reads)
+    with open_input(path) as sprofile:
+        for line in sprofile:
+            if line.startswith("#reads="):
+                reads = int(line[len("#reads="):])
+            elif line.startswith("Chr FW") and "reads=" in line:
+                reads = int(line.rsplit("reads=", 1)[1])
+    return(reads)
+def sprofile_to_text(binary, sprofile):
+    with BinarySprofile(binary) as rows, open(sprofile, "w") as output:
+        output.write(sprofile_header)
+        for line in rows.lines():
+            output.write(line)
+        output.write("#reads="+str(rows.reads)+"\n")
@@ -0,0 +1,62 @@
+# TransloCapture matrices (.csv) as labelled arrays, so matrices are compared by target name rather than by the position of their cells.
+# A matrix has a row per acceptor and a column per donor, as written by TransloCapture. Its values are held in one flat array of doubles, row after row, with NA as nan.
+from array import array
+from operator import sub
+
+
+
+nan = float("nan")
+
+class TranslocationMatrix(object):
+    def __init__(self, rows, columns, values):
+        self.rows = rows
+        self.columns = columns
+        self.values = values
+    def take(self, rows, columns):
+        # the values of the given rows and columns, in that order, with nan for any target that is not in this matrix.
+        row_index = dict((name, i) for i, name in enumerate(self.rows))
+        column_index = dict((name, i) for i, name in enumerate(self.columns))
+        width = len(self.columns)
+        # missing cells point at -1, the nan added to the end of the values.
+        cells = [row_index[row]*width+column_index[column] if row in row_index and column in column_index else -1 for row in rows for column in columns]
+        values = self.values+array("d", [nan])
+        return(array("d", map(values.__getitem__, cells)))
+    def diff(self, control):
+        # this matrix minus the control, cell by cell after aligning the control's targets to this matrix. Cells that are NA in either, or targets missing from the control, are NA.
+        if control.rows == self.rows and control.columns == self.columns:
+            aligned = control.values
+        else:
+            aligned = control.take(self.rows, self.columns)
+        return(TranslocationMatrix(self.rows, self.columns, array("d", map(sub, self.values, aligned))))
+    def write(self, path):
+        cells = ["NA" if value != value else str(value) for value in self.values]
+        width = len(self.columns)
+        with open(path, "w") as outputfile:
+            outputfile.write(","+",".join(self.columns)+"\n")
+            for i, row in enumerate(self.rows):
+                outputfile.write(row+","+",".join(cells[i*width:(i+1)*width])+"\n")
+def read_matrix(path):
+    # reads a TransloCapture matrix csv into a TranslocationMatrix, raises ValueError if a cell is neither a number nor NA.
+    rows = list()
+    values = array("d")
+    with open(path) as matrix:
+        columns = matrix.readline().rstrip("\r\n").split(",")[1:]
+        for line in matrix:
+            cells = line.rstrip("\r\n").split(",")
+            if len(cells) < 2:
+                continue
+            if len(cells) != len(columns)+1:
+                raise ValueError(path+" has "+str(len(cells)-1)+" values in the row of "+cells[0]+" but "+str(len(columns))+" targets in its header.")
+            rows.append(cells[0])
+            values.extend([nan if cell in ("NA", "") else float(cell) for cell in cells[1:]])
+    return(TranslocationMatrix(rows, columns, values))
+def diff_matrices(control, treated, outputs):
+    # writes the differential of each treated matrix csv to the control matrix csv, the control is read once for all of them.
+    # returns the targets of each treated matrix that are missing from the control.
+    control_matrix = read_matrix(control)
+    missing = list()
+    for treated_path, output in zip(treated, outputs):
+        treated_matrix = read_matrix(treated_path)
+        treated_matrix.diff(control_matrix).write(output)
+        missing.append(sorted(set(treated_matrix.rows+treated_matrix.columns)-set(control_matrix.rows+control_matrix.columns)))
+    return(missing)
@@ -0,0 +1,62 @@
+# EventClusters on planted structural variant events among background discordant pairs.
+import random
+from mProfile.breakpoints import EventClusters
+
+
+contigs = ["c1", "c2"]
+window = 2000
+
+def read_events(path):
+    with open(path) as events:
+        next(events)
+        return([line.rstrip("\n").split("\t") for line in events])
+
+def cluster(rows, path, min_support=3):
+    # adds the rows (ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, aberration) in the sorted order of StructureMap and returns the events written.
+    events = EventClusters(path, contigs, window=window, min_support=min_support)
+    for ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, aberration in sorted(rows):
+        events.add(ref_x, ref_y, coord_x, coord_y, strand_x, strand_y, coord_y-coord_x, aberration, 97)
+    events.close()
+    return(read_events(path))
+
+def planted_rows(rng):
+    # three events, each of 20 pairs scattered within a few hundred bp of its two breakpoints.
+    planted = [(0, 0, 50000, 150000, "+", "-", "Deletion"), (0, 1, 400000, 20000, "+", "+", "Inter-chromosomal translocation"), (0, 0, 700000, 720000, "-", "-", "Same strand")]
+    rows = list()
+    for ref_x, ref_y, break_x, break_y, strand_x, strand_y, aberration in planted:
+        for i in range(20):
+            rows.append((ref_x, ref_y, break_x+rng.randint(0, 400), break_y+rng.randint(0, 400), strand_x, strand_y, aberration))
+    return(planted, rows)
+
+def noise_rows(rng, pairs=1000, spread=50000):
+    # discordant pairs at random, closer together along the forward reads than the window but with unrelated reverse reads. The deletions' reverse reads are all within 'spread' of their forward reads, so they overlap those of their neighbours.
+    rows = list()
+    for i in range(pairs):
+        coord_x = rng.randint(0, 1000000)
+        rows.append((0, 0, coord_x, coord_x+rng.randint(5000, spread), "+", "-", "Deletion"))
+        rows.append((0, 0, coord_x, rng.randint(0, 1000000), "+", "+", "Same strand"))
+    return(rows)
+
+def test_events_within_window(tmp_path):
+    rng = random.Random(2)
+    planted, rows = planted_rows(rng)
+    events = cluster(rows+noise_rows(rng), str(tmp_path/"events.tsv"))
+    for chr_x, start_x, end_x, chr_y, start_y, end_y, strand_x, strand_y, aberration, pairs in events:
+        assert int(end_x)-int(start_x) <= window
+        assert int(end_y)-int(start_y) <= window
+    # each planted event is found once, with all of its pairs.
+    for ref_x, ref_y, break_x, break_y, strand_x, strand_y, aberration in planted:
+        found = [event for event in events if event[0] == contigs[ref_x] and event[3] == contigs[ref_y] and event[8] == aberration and int(event[1]) <= break_x+400 and int(event[2]) >= break_x]
+        assert len(found) == 1
+        assert int(found[0][4]) <= break_y+400 and int(found[0][5]) >= break_y
+        assert int(found[0][9]) >= 20
+
+def test_noise_alone(tmp_path):
+    # sparser background pairs alone support no events, though many are within a window of their neighbours.
+    events = cluster(noise_rows(random.Random(2), pairs=500, spread=100000), str(tmp_path/"events.tsv"))
+    assert events == []
+
+def test_min_support(tmp_path):
+    rows = [(0, 0, 1000+i*10, 9000+i*10, "+", "-", "Deletion") for i in range(3)]
+    assert len(cluster(rows, str(tmp_path/"three.tsv"), min_support=3)) == 1
+    assert cluster(rows, str(tmp_path/"four.tsv"), min_support=4) == []
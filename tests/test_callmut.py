@@ -0,0 +1,163 @@
+# callMUT's mpileup conversion compared to the original de_indel, kept below as it was before tally_pileup, on generated mpileup lines.
+import random
+import sys
+from re import sub, findall, finditer
+import pytest
+
+# callMUT parses the command line when it is imported, so it is given a valid one.
+argv = sys.argv
+sys.argv = ["callMUT", "-i", "-", "-o", "-"]
+from mProfile import callMUT
+sys.argv = argv
+
+
+def original_de_indel(argues):
+    mpileup_base = argues[0]
+    cutoff = argues[1]
+    sml_len = argues[2]
+    mid_len1 = argues[3]
+    mid_len2 = argues[4]
+    lrg_len = argues[5]
+    columns = mpileup_base.split("\t")
+    chr = columns[0]
+    coordinate = columns[1]
+    base = columns[2]
+    readcount = int(columns[3])
+    reads = sub('\\^.', "", columns[4])
+    startlocations = list()
+    endlocations = list()
+    length_diff = 0
+    indel_sequences = ""
+    if readcount>0:
+        indels = findall(r'\d+', reads)
+        for match in finditer(r'\d+', reads):
+            startlocations.append(int(match.start()))
+            endlocations.append(int(match.end()))
+        for startlocation, endlocation, indel in zip(startlocations, endlocations, indels):
+            if indel != '':
+                indel_sequences = indel_sequences+(reads[(startlocation-1-length_diff):(endlocation+int(indel)-length_diff)]).upper()+","
+                oldlength = len(reads)
+                reads = reads[:(endlocation-length_diff)] + reads[(endlocation + int(indel) - length_diff):]
+                newlength = len(reads)
+                length_diff = length_diff + (oldlength - newlength)
+        formatted_indels = ""
+        for indel in set(indel_sequences.split(",")):
+            if indel != '':
+                rate = (indel_sequences.count(indel)/readcount)*100
+                if str(cutoff).upper() != "NA":
+                    if rate > float(cutoff):
+                        formatted_indels = formatted_indels+(indel+":"+str(rate)+",")
+                else:
+                    formatted_indels = formatted_indels+(indel+":"+str(rate)+",")
+        a_rate = (reads.upper().count("A")/readcount)*100
+        t_rate = (reads.upper().count("T")/readcount)*100
+        g_rate = (reads.upper().count("G")/readcount)*100
+        c_rate = (reads.upper().count("C")/readcount)*100
+        in_rate = (reads.count("+")/readcount)*100
+        del_rate = (reads.count("-")/readcount)*100
+        sml_rate = (sum(int(indel) <= sml_len for indel in indels)/readcount)*100
+        mid_rate = (sum(mid_len1 <= int(indel) <= mid_len2 for indel in indels)/readcount)*100
+        lrg_rate = (sum(int(indel) >= lrg_len for indel in indels)/readcount)*100
+        snv_rate = a_rate + t_rate + g_rate + c_rate
+        if base == "G":
+            transition = a_rate
+            transversion = t_rate + c_rate
+        elif base == "C":
+            transition = t_rate
+            transversion = a_rate + g_rate
+        elif base == "T":
+            transition = c_rate
+            transversion = a_rate + g_rate
+        elif base == "A":
+            transition = g_rate
+            transversion = t_rate + c_rate
+    else:
+        a_rate = 0
+        t_rate = 0
+        g_rate = 0
+        c_rate = 0
+        transition=0
+        transversion=0
+        snv_rate=0
+        in_rate = 0
+        del_rate = 0
+        sml_rate = 0
+        mid_rate = 0
+        lrg_rate = 0
+        formatted_indels = ""
+    return(('\t'.join([chr, coordinate, base, str(readcount), str(a_rate), str(t_rate), str(g_rate), str(c_rate), str(transition), str(transversion), str(snv_rate), str(in_rate), str(del_rate), str(sml_rate), str(mid_rate), str(lrg_rate), formatted_indels]))+"\n")
+
+def pileup_read(rng):
+    # one read's bases at a position: a read start (^ and a mapping quality, which may be any character), a match, mismatch or deletion, then an indel, a read end ($) or nothing.
+    call = ""
+    if rng.random() < 0.1:
+        call += "^"+chr(rng.randint(33, 126))
+    call += rng.choice(".,.,.,ACGTNacgtn*")
+    roll = rng.random()
+    if roll < 0.25:
+        # small, mid and large indels, some with multi-digit lengths and mixed-case sequences.
+        length = rng.choice([1, 1, 2, 3, 4, 5, 7, 10, 12, 23])
+        sequence = "".join([rng.choice("ACGTNacgtn") for i in range(length)])
+        if rng.random() < 0.5:
+            sequence = rng.choice([sequence.upper(), sequence.lower()])
+        call += rng.choice("+-")+str(length)+sequence
+    elif roll < 0.35:
+        call += "$"
+    return(call)
+
+def pileup_lines(seed, lines=400):
+    rng = random.Random(seed)
+    for position in range(1, lines+1):
+        base = rng.choice("ACGT")
+        readcount = rng.choice([0, 0, 1, 2, 3, 5, 10, 40, 100, 150])
+        if readcount == 0:
+            yield("chr1\t"+str(position)+"\t"+base+"\t0\t"+rng.choice(["*", ""])+"\t*\n")
+        else:
+            reads = "".join([pileup_read(rng) for i in range(readcount)])
+            yield("chr1\t"+str(position)+"\t"+base+"\t"+str(readcount)+"\t"+reads+"\t"+"I"*readcount+"\n")
+
+def same_row(new, old):
+    # the rate columns must match as text, the Common.Indels in any order.
+    new = new.rstrip("\n").split("\t")
+    old = old.rstrip("\n").split("\t")
+    return(new[:16] == old[:16] and sorted(new[16].split(",")) == sorted(old[16].split(",")))
+
+@pytest.mark.parametrize("cutoff", ["NA", 1.0, 0.3])
+def test_de_indel(cutoff):
+    for mpileup_base in pileup_lines(7):
+        argues = [mpileup_base, cutoff, 1, 2, 4, 5]
+        new = callMUT.de_indel(argues)
+        old = original_de_indel(argues)
+        assert same_row(new, old), mpileup_base
+
+def test_tally_pileup():
+    reads, lengths, indel_counts = callMUT.tally_pileup(",+2Ag.-12ACGTACGTACGTa+2AG$*-1n,")
+    assert reads == ",+2.-12a+2$*-1,"
+    assert lengths == [2, 12, 2, 1]
+    assert indel_counts == {"+2AG": 2, "-12ACGTACGTACGT": 1, "-1N": 1}
+    assert callMUT.tally_pileup("..,,ACg*$") == ("..,,ACg*$", [], {})
+
+def test_tally_pileup_original():
+    # the read bases left after the indels are removed give the same base counts as the original.
+    for mpileup_base in pileup_lines(11):
+        columns = mpileup_base.split("\t")
+        if int(columns[3]) > 0:
+            reads, lengths, indel_counts = callMUT.tally_pileup(sub('\\^.', "", columns[4]))
+            old = original_de_indel([mpileup_base, "NA", 1, 2, 4, 5]).split("\t")
+            readcount = int(columns[3])
+            assert str((reads.upper().count("A")/readcount)*100) == old[4]
+            assert str((reads.count("-")/readcount)*100) == old[12]
+            assert sum(indel_counts.values()) == len(lengths)
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_write_mprofile(tmp_path, threads):
+    # whole mpileups converted in one process or in batches across processes match the original line by line.
+    lines = list(pileup_lines(3, lines=3000))
+    mprofile = tmp_path/"out.mprofile"
+    with open(mprofile, "w") as outputfile:
+        callMUT.write_mprofile(iter(lines), outputfile, [1.0, 1, 2, 4, 5], threads=threads)
+    with open(mprofile) as outputfile:
+        written = outputfile.readlines()
+    assert len(written) == len(lines)
+    for new, mpileup_base in zip(written, lines):
+        assert same_row(new, original_de_indel([mpileup_base, 1.0, 1, 2, 4, 5])), mpileup_base
@@ -0,0 +1,157 @@
+# TransloCapture's primer matching (PrimerPanel) compared to the original donor and acceptor loops, kept below as they were before the primer index, on generated reads.
+import random
+import pytest
+from mProfile.primers import PrimerPanel, PrimerIndex, MismatchIndex, rev_comp, read_primers
+
+
+def original_classify(read, read2, site_file, sens):
+    # the loops of the original TransloCapture for a SR read (read2 is None) or PE read pair, returning what PrimerPanel.classify returns.
+    primer_names, fw_primer_list, rv_primer_list, fw_lens, rv_lens = read_primers(site_file, sens)
+    for donor, (rv, fw, rv_l, fw_l) in enumerate(zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens)):
+        if read2 is None:
+            if fw in read[:fw_l]:
+                if rev_comp(rv) in read[-(rv_l):]:
+                    return((donor, None, "fw", None))
+                for acceptor, (all_rv, all_fw, arv_l, afw_l) in enumerate(zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens)):
+                    if primer_names[donor] != primer_names[acceptor]:
+                        if rev_comp(all_rv) in read[-(arv_l):]:
+                            return((donor, acceptor, "fw", "rv"))
+                        elif rev_comp(all_fw) in read[-(afw_l):]:
+                            return((donor, acceptor, "fw", "fw"))
+            elif rv in read[:rv_l]:
+                if rev_comp(fw) in read[-(fw_l):]:
+                    return((donor, None, "rv", None))
+                for acceptor, (all_rv, all_fw, arv_l, afw_l) in enumerate(zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens)):
+                    if primer_names[donor] != primer_names[acceptor]:
+                        if rev_comp(all_fw) in read[-(afw_l):]:
+                            return((donor, acceptor, "rv", "rv"))
+                        elif rev_comp(all_rv) in read[-(arv_l):]:
+                            return((donor, acceptor, "rv", "fw"))
+        else:
+            if fw in read[:fw_l]:
+                if rv in read2[:rv_l]:
+                    return((donor, None, "fw", None))
+                for acceptor, (all_rv, all_fw, arv_l, afw_l) in enumerate(zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens)):
+                    if primer_names[donor] != primer_names[acceptor]:
+                        if all_rv in read2[:arv_l]:
+                            return((donor, acceptor, "fw", "rv"))
+                        elif all_fw in read2[:afw_l]:
+                            return((donor, acceptor, "fw", "fw"))
+            elif rv in read[:rv_l]:
+                if fw in read2[:fw_l]:
+                    return((donor, None, "rv", None))
+                for acceptor, (all_rv, all_fw, arv_l, afw_l) in enumerate(zip(rv_primer_list, fw_primer_list, rv_lens, fw_lens)):
+                    if primer_names[donor] != primer_names[acceptor]:
+                        if all_rv in read2[:arv_l]:
+                            return((donor, acceptor, "rv", "rv"))
+                        elif all_fw in read2[:afw_l]:
+                            return((donor, acceptor, "rv", "fw"))
+    return(None)
+
+def random_sequence(rng, length):
+    return("".join([rng.choice("ACGT") for i in range(length)]))
+
+def write_primers(rng, path, targets=12):
+    # primers of 17-27 bases, with one pair of forward primers sharing their first 15 bases and one primer that is a prefix of another.
+    primers = [("T"+str(i), random_sequence(rng, rng.randint(17, 27)), random_sequence(rng, rng.randint(17, 27))) for i in range(targets)]
+    primers[3] = (primers[3][0], primers[2][1][:15]+random_sequence(rng, 6), primers[3][2])
+    primers[5] = (primers[5][0], primers[5][1], primers[4][2][:-3])
+    with open(path, "w") as sites:
+        for name, fw, rv in primers:
+            sites.write(name+","+fw+","+rv+"\n")
+    return(primers)
+
+def mutate(rng, sequence):
+    # a base substituted in a fifth of the primers, so some reads only match with mismatches or not at all.
+    if rng.random() < 0.2:
+        i = rng.randrange(len(sequence))
+        sequence = sequence[:i]+rng.choice("ACGT")+sequence[i+1:]
+    return(sequence)
+
+def generated_reads(rng, primers, reads=3000):
+    # canonical amplicons and crossovers (a third) from either primer of the donor, with a few bases before the primers, unprimed and lower case starts and 150 bp PE reads.
+    for i in range(reads):
+        donor = rng.choice(primers)
+        acceptor = rng.choice(primers) if rng.random() < 0.3 else donor
+        donor_fw = rng.random() < 0.5
+        start = donor[1] if donor_fw else donor[2]
+        if acceptor is donor:
+            end = donor[2] if donor_fw else donor[1]
+        else:
+            end = rng.choice([acceptor[1], acceptor[2]])
+        if rng.random() < 0.1:
+            start = random_sequence(rng, 20)
+        sequence = random_sequence(rng, rng.choice([0, 0, 0, 1, 2, 3]))+mutate(rng, start)+random_sequence(rng, rng.randint(30, 120))+rev_comp(mutate(rng, end))+rev_comp(random_sequence(rng, rng.choice([0, 0, 1, 2, 4])))
+        if rng.random() < 0.05:
+            sequence = sequence[:5].lower()+sequence[5:]
+        length = min(len(sequence), 150)
+        yield(sequence, sequence[:length], rev_comp(sequence)[:length])
+
+@pytest.mark.parametrize("sens", [0, 2, 5])
+def test_classify_sr(tmp_path, sens):
+    rng = random.Random(sens)
+    site_file = str(tmp_path/"primers.csv")
+    primers = write_primers(rng, site_file)
+    panel = PrimerPanel(site_file, sens, paired=False)
+    for sequence, read1, read2 in generated_reads(rng, primers):
+        assert panel.classify(sequence) == original_classify(sequence, None, site_file, sens), sequence
+
+@pytest.mark.parametrize("sens", [0, 2, 5])
+def test_classify_pe(tmp_path, sens):
+    rng = random.Random(10+sens)
+    site_file = str(tmp_path/"primers.csv")
+    primers = write_primers(rng, site_file)
+    panel = PrimerPanel(site_file, sens, paired=True)
+    for sequence, read1, read2 in generated_reads(rng, primers):
+        assert panel.classify(read1, read2) == original_classify(read1, read2, site_file, sens), (read1, read2)
+
+@pytest.mark.parametrize("sens", [0, 3])
+def test_mismatch_index_exact(tmp_path, sens):
+    # with no mismatches allowed, the mismatch index finds the same primers at the same offsets as the exact index.
+    rng = random.Random(20+sens)
+    site_file = str(tmp_path/"primers.csv")
+    primers = write_primers(rng, site_file)
+    names, fw_primers, rv_primers, fw_lens, rv_lens = read_primers(site_file, sens)
+    patterns = [(2*i, fw, fw_l) for i, (fw, fw_l) in enumerate(zip(fw_primers, fw_lens))]+[(2*i+1, rv, rv_l) for i, (rv, rv_l) in enumerate(zip(rv_primers, rv_lens))]
+    exact = PrimerIndex(patterns)
+    mismatch = MismatchIndex(patterns, 0)
+    for sequence, read1, read2 in generated_reads(rng, primers):
+        assert mismatch.find(read1) == exact.find(read1)
+        assert mismatch.find(read2) == exact.find(read2)
+
+def near_identical_primers(path):
+    # the forward primers of A and B differ by one base, the reverse primers are unrelated.
+    rng = random.Random(30)
+    fw_a = random_sequence(rng, 22)
+    fw_b = fw_a[:12]+("A" if fw_a[12] != "A" else "C")+fw_a[13:]
+    primers = [("A", fw_a, random_sequence(rng, 22)), ("B", fw_b, random_sequence(rng, 22)), ("C", random_sequence(rng, 22), random_sequence(rng, 22))]
+    with open(path, "w") as sites:
+        for name, fw, rv in primers:
+            sites.write(name+","+fw+","+rv+"\n")
+    return(primers, random_sequence(rng, 80))
+
+@pytest.mark.parametrize("paired", [False, True])
+def test_near_identical_primers(tmp_path, paired):
+    # with mismatches allowed, a read matching one primer exactly is not assigned to its one base neighbour, which would make canonical amplicons into crossovers.
+    site_file = str(tmp_path/"primers.csv")
+    primers, insert = near_identical_primers(site_file)
+    exact = PrimerPanel(site_file, 2, paired=paired)
+    panel = PrimerPanel(site_file, 2, paired=paired, mismatches=1)
+    def classify(panel, start, end):
+        sequence = start+insert+rev_comp(end)
+        if paired:
+            return(panel.classify(sequence, rev_comp(sequence)))
+        return(panel.classify(sequence))
+    (a, fw_a, rv_a), (b, fw_b, rv_b), (c, fw_c, rv_c) = primers
+    assert classify(panel, fw_b, rv_b) == classify(exact, fw_b, rv_b) == (1, None, "fw", None)
+    assert classify(panel, fw_a, rv_a) == classify(exact, fw_a, rv_a) == (0, None, "fw", None)
+    assert classify(panel, fw_b, rv_c) == classify(exact, fw_b, rv_c) == (1, 2, "fw", "rv")
+    assert classify(panel, rv_b, fw_b) == classify(exact, rv_b, fw_b) == (1, None, "rv", None)
+    # a read with an error in B's primer is still canonical B, one base from B and two from A.
+    fw_b_error = fw_b[:5]+("A" if fw_b[5] != "A" else "C")+fw_b[6:]
+    assert classify(panel, fw_b_error, rv_b) == (1, None, "fw", None)
+
+def test_mismatch_counts():
+    index = MismatchIndex([(0, "ACGTACGTACGT", 14), (1, "ACGTACGAACGT", 14)], 1)
+    assert index.find("ACGTACGTACGTTT") == {0: (0, 0), 1: (0, 1)}
+    assert PrimerIndex([(0, "ACGTACGTACGT", 14)]).find("TACGTACGTACGTT") == {0: (1, 0)}